@@ -0,0 +1,198 @@
+'''
+Compares the anatomy removed in sessions drilled on the same volume. Every session is reduced once to a packed bitset
+of removed voxels on the volume grid (cached in --cache_dir), the comparisons are bitwise operations on those bitsets:
+removed voxels per segment, overlap (dice) between all sessions and, with --expert, over- and under-drilling of each
+session relative to the expert. Only the bytes of the bitsets in which any session removed a voxel are compared, so a
+cohort is compared in about the time it takes to read its bitsets.
+
+Sessions are directories of recorded hdf5 chunks (or single files):
+python3 compare_sessions.py --volume_adf ../../ADF/volume_171.yaml --sessions ~/study/* --expert ~/study/expert
+'''
+import hashlib
+import json
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+import yaml
+from PIL import Image
+
+from volume_state import adf_slice_files
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits, axis=-1):
+    """
+    number of set bits of packed uint8 bitsets along axis
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits).sum(axis=axis, dtype=np.int64)
+    return POPCOUNT[bits].sum(axis=axis, dtype=np.int64)
+
+
+def session_files(path):
+    path = Path(path)
+    return sorted(path.rglob('*.hdf5')) if path.is_dir() else [path]
+
+
+def files_key(files, extra=''):
+    """
+    cache key from path, size and mtime of every file
+    """
+    sha = hashlib.sha1(extra.encode())
+    for filename in files:
+        stat = os.stat(filename)
+        sha.update(("%s|%d|%d" % (Path(filename).resolve(), stat.st_size, stat.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+
+def load_adf_labels(adf_path):
+    """
+    segments of a volume by color of its PNG stack
+    :return: XxYxZ uint8 labels in plugin order (0 is empty), RGB color of label i + 1 at row i
+    """
+    slice_files = adf_slice_files(adf_path)
+    labels, colors = None, {}
+    for nz, im_name in enumerate(slice_files):
+        im = np.asarray(Image.open(im_name))
+        if im.ndim == 2:
+            im = np.repeat(im[..., None], 3, axis=-1)
+        occupied = np.any(im != 0, axis=-1)
+        keys = (im[..., 0].astype(np.uint32) << 16) | (im[..., 1].astype(np.uint32) << 8) | im[..., 2]
+        unique, inverse = np.unique(keys[occupied], return_inverse=True)
+        for key in unique:
+            colors.setdefault(int(key), len(colors) + 1)
+        if len(colors) > 255:
+            raise ValueError('At most 255 segment colors are supported')
+        lut = np.array([colors[int(key)] for key in unique], dtype=np.uint8)
+        if labels is None:
+            labels = np.zeros([im.shape[1], im.shape[0], len(slice_files)], dtype=np.uint8)
+        im_labels = np.zeros(im.shape[:2], dtype=np.uint8)
+        im_labels[occupied] = lut[inverse.reshape(-1)]
+        labels[:, :, nz] = im_labels.T
+    palette = np.array([[key >> 16, (key >> 8) & 255, key & 255] for key in colors], dtype=np.uint8).reshape(-1, 3)
+    return labels, palette
+
+
+def volume_segments(adf_path, cache_dir):
+    """
+    :return: grid shape, SxB packed bitset of every segment, Sx3 RGB colors. Cached by the ADF and its PNG stack
+    """
+    key = files_key([Path(adf_path)] + adf_slice_files(adf_path), 'volume')
+    cache_file = Path(cache_dir) / ('volume_' + key + '.npz')
+    if cache_file.exists():
+        with np.load(cache_file) as data:
+            return tuple(int(s) for s in data['shape']), data['segments'], data['palette']
+
+    labels, palette = load_adf_labels(adf_path)
+    flat = labels.reshape(-1)
+    segments = np.stack([np.packbits(flat == i + 1) for i in range(len(palette))]) if len(palette) else \
+        np.zeros((0, (flat.size + 7) // 8), dtype=np.uint8)
+    np.savez(cache_file, shape=labels.shape, segments=segments, palette=palette)
+    return labels.shape, segments, palette
+
+
+def removed_bitset(files, shape, chunk_size=1 << 20):
+    """
+    packed bitset (np.packbits order) of every voxel removed in the session, the removal table is read in chunks
+    """
+    bits = np.zeros((int(np.prod(shape)) + 7) // 8, dtype=np.uint8)
+    for filename in files:
+        with h5py.File(filename, 'r') as f:
+            if 'voxel_removed' not in f.get('voxels_removed', {}):
+                continue
+            table = f['voxels_removed/voxel_removed']
+            for start in range(0, table.shape[0], chunk_size):
+                indices = table[start:start + chunk_size, 1:].astype(np.int64)
+                flat = np.unique(np.ravel_multi_index(indices.T, shape, mode='clip'))
+                np.bitwise_or.at(bits, flat >> 3, (1 << (7 - (flat & 7))).astype(np.uint8))
+    return bits
+
+
+def session_bitset(path, shape, cache_dir):
+    files = session_files(path)
+    key = files_key(files, str(tuple(shape)))
+    cache_file = Path(cache_dir) / ('session_' + key + '.npy')
+    if cache_file.exists():
+        return np.load(cache_file)
+    bits = removed_bitset(files, shape)
+    np.save(cache_file, bits)
+    return bits
+
+
+def color_name(color):
+    return '#%02x%02x%02x' % tuple(int(c) for c in color)
+
+
+def compare(sessions, segments, expert=None):
+    """
+    :param sessions: NxB packed removed voxels, segments: SxB packed segment masks, expert: index into sessions
+    :return: dict of per-session counts (N), per-segment counts (NxS), pairwise overlap (NxN) and expert comparison
+    """
+    # bytes in which no session removed anything do not contribute to any count
+    columns = np.flatnonzero(np.bitwise_or.reduce(sessions, axis=0))
+    sessions = sessions[:, columns]
+    segments = segments[:, columns]
+
+    removed = popcount(sessions)
+    intersection = np.stack([popcount(sessions[i] & sessions) for i in range(len(sessions))])
+    total = removed[:, None] + removed[None]
+    result = dict(removed=removed,
+                  per_segment=popcount(sessions[:, None] & segments[None]),
+                  dice=np.divide(2 * intersection, total, out=np.ones(total.shape), where=total > 0))
+    if expert is not None:
+        over = sessions & ~sessions[expert]
+        under = sessions[expert] & ~sessions
+        result['over'] = popcount(over)
+        result['under'] = popcount(under)
+        result['over_per_segment'] = popcount(over[:, None] & segments[None])
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--volume_adf', type=str, required=True, help='ADF of the volume all sessions drilled')
+    parser.add_argument('--sessions', type=str, nargs='+', required=True, help='Session directories or hdf5 files')
+    parser.add_argument('--expert', type=str, default=None, help='Session the others are compared against')
+    parser.add_argument('--segment_names', type=str, default=None,
+                        help='yaml mapping segment names to RGB colors of the PNG stack, colors are shown otherwise')
+    parser.add_argument('--cache_dir', type=str, default='.compare_cache', help='Directory of cached bitsets')
+    parser.add_argument('--report', type=str, default=None, help='Write the comparison to this json')
+    args = parser.parse_args()
+
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    shape, segments, palette = volume_segments(args.volume_adf, cache_dir)
+    names = [color_name(c) for c in palette]
+    if args.segment_names is not None:
+        with open(args.segment_names, 'r') as fp:
+            by_color = {color_name(c): name for name, c in yaml.safe_load(fp).items()}
+        names = [by_color.get(n, n) for n in names]
+
+    paths = list(args.sessions)
+    if args.expert is not None and args.expert not in paths:
+        paths.append(args.expert)
+    sessions = np.stack([session_bitset(p, shape, cache_dir) for p in paths])
+    expert = paths.index(args.expert) if args.expert is not None else None
+    result = compare(sessions, segments, expert)
+
+    for i, path in enumerate(paths):
+        line = "%s removed: %8d" % (path, result['removed'][i])
+        if expert is not None:
+            line += " dice: %.3f over: %8d under: %8d" % (result['dice'][i, expert], result['over'][i],
+                                                           result['under'][i])
+        print(line)
+        print("    " + " ".join("%s: %d" % (n, c) for n, c in zip(names, result['per_segment'][i]) if c > 0))
+
+    if args.report is not None:
+        report = dict(sessions=paths, segments=names, expert=args.expert)
+        report.update({k: v.tolist() for k, v in result.items()})
+        with open(args.report, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
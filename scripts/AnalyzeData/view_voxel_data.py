@@ -30,8 +30,11 @@ def main(f):
 
     print(f"voxel df\n{voxel_color.head()}\n")
 
-    print(f"voxels removed at step 5000 {voxel_color.loc[voxel_color['ts']==5000].shape}")
-    print(f"voxels removed at step 8000 {voxel_color.loc[voxel_color['ts']==8000].shape}")
+    # rows are written in message order, so the rows of one step are a contiguous slice of the sorted column
+    steps = voxel_color["ts"].to_numpy()
+    for step in [5000, 8000]:
+        start, end = np.searchsorted(steps, [step, step + 1], side="left")
+        print(f"voxels removed at step {step} {voxel_color.iloc[start:end].shape}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import time
+
+import h5py
+import numpy as np
+import yaml
+from PIL import Image
+
+
+def adf_slice_files(adf_path):
+    """
+    PNG slices of the volume referenced by an ADF, sorted by slice index. The ADF count is an upper bound the plugin
+    stops at, the stacks usually hold fewer slices
+    """
+    adf_path = Path(adf_path)
+    with open(adf_path, 'r') as adf:
+        params = yaml.safe_load(adf)
+    images = params[params['volumes'][0]]['images']
+    images_path = (adf_path.parent / images['path']).resolve()
+    prefix, suffix = images['prefix'], '.' + images['format']
+    slices = {}
+    for im_name in images_path.glob(prefix + '*' + suffix):
+        index = im_name.name[len(prefix):-len(suffix)]
+        if index.isdigit():
+            slices[int(index)] = im_name
+    count = 0
+    while count in slices and count < images['count']:
+        count += 1
+    return [slices[nz] for nz in range(count)]
+
+
+def load_adf_volume(adf_path):
+    """
+    load the initial occupancy of a volume from the PNG stack referenced by its ADF
+    :return: XxYxZ bool, indexed like the voxel indices published by the plugin (x: image column, y: image row,
+    z: slice)
+    """
+    slice_files = adf_slice_files(adf_path)
+    occupancy = None
+    for nz, im_name in enumerate(slice_files):
+        im = np.asarray(Image.open(im_name))
+        if im.ndim == 3:
+            im = np.any(im != 0, axis=-1)
+        else:
+            im = im != 0
+        if occupancy is None:
+            occupancy = np.zeros([im.shape[1], im.shape[0], len(slice_files)], dtype=bool)
+        occupancy[:, :, nz] = im.T
+    return occupancy
+
+
+def load_removed_voxels(files):
+    """
+    gather the voxel removal history of a session, recorded chunk files are passed in recording order
+    :return: time stamps (M), voxel indices (Mx3 int), voxel colors (Mx4 uint8), sorted by time
+    """
+    times, indices, colors = [], [], []
+    for filename in files:
+        with h5py.File(filename, 'r') as f:
+            if 'voxel_removed' not in f['voxels_removed']:
+                continue
+            voxel_ts = f['voxels_removed/voxel_time_stamp'][()]
+            voxel_removed = f['voxels_removed/voxel_removed'][()]
+            voxel_color = f['voxels_removed/voxel_color'][()]
+        # the first column counts all voxel messages while time stamps are only kept for non-empty ones
+        _, msg_idx = np.unique(voxel_removed[:, 0], return_inverse=True)
+        times.append(voxel_ts[msg_idx.reshape(-1)])
+        indices.append(voxel_removed[:, 1:].astype(np.int64))
+        colors.append(voxel_color[:, 1:].astype(np.uint8))
+
+    if len(times) == 0:
+        return np.zeros(0), np.zeros([0, 3], dtype=np.int64), np.zeros([0, 4], dtype=np.uint8)
+    times = np.concatenate(times)
+    order = np.argsort(times, kind='stable')
+    return times[order], np.concatenate(indices)[order], np.concatenate(colors)[order]
+
+
+class VolumeState:
+    """
+    Reconstructs the volume at any time from the initial occupancy and the removal history. The occupancy is stored
+    as packed keyframes every keyframe_interval removals, so a seek costs one keyframe plus at most
+    keyframe_interval removals. Seeking forward from the last state only applies the delta. At most max_keyframes are
+    kept, longer sessions space them further apart so memory does not grow with the session.
+    """
+    def __init__(self, initial, times, indices, keyframe_interval=20000, max_keyframes=32):
+        self.shape = initial.shape
+        self.times = times
+        self.indices = np.ravel_multi_index(indices.T, self.shape, mode='clip') if len(indices) else \
+            np.zeros(0, dtype=np.int64)
+        # the first keyframe is the initial volume
+        self.keyframe_interval = max(keyframe_interval, -(-len(self.indices) // max(max_keyframes - 1, 1)))
+        self.initial_count = int(np.count_nonzero(initial))
+
+        # a voxel only counts as removed the first time it is reported
+        flat = initial.reshape(-1)
+        first = np.zeros(len(self.indices), dtype=bool)
+        _, first_idx = np.unique(self.indices, return_index=True)
+        first[first_idx] = True
+        self.removed_cumsum = np.cumsum(first & flat[self.indices])
+
+        self.keyframes = []
+        occupancy = flat.copy()
+        for start in range(0, len(self.indices) + 1, self.keyframe_interval):
+            occupancy[self.indices[max(start - self.keyframe_interval, 0):start]] = False
+            self.keyframes.append(np.packbits(occupancy))
+
+        self._last_step = 0
+        self._last_occupancy = flat.copy()
+
+    def step_at(self, t):
+        """
+        number of removals applied at time t
+        """
+        return int(np.searchsorted(self.times, t, side='right'))
+
+    def seek(self, t):
+        """
+        :return: XxYxZ bool occupancy at time t, the array is reused by the next seek
+        """
+        step = self.step_at(t)
+        key = step // self.keyframe_interval
+        key_step = key * self.keyframe_interval
+        if not (key_step <= self._last_step <= step):
+            self._last_occupancy = np.unpackbits(self.keyframes[key], count=self._last_occupancy.size).astype(bool)
+            self._last_step = key_step
+        self._last_occupancy[self.indices[self._last_step:step]] = False
+        self._last_step = step
+        return self._last_occupancy.reshape(self.shape)
+
+    def removed_count(self, t):
+        step = self.step_at(t)
+        return int(self.removed_cumsum[step - 1]) if step > 0 else 0
+
+    def remaining_count(self, t):
+        return self.initial_count - self.removed_count(t)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--volume_adf', type=str, required=True, help='ADF of the drilled volume')
+    parser.add_argument('--files', type=str, nargs='+', required=True, help='Recorded hdf5 files in order')
+    parser.add_argument('--keyframe_interval', type=int, default=20000)
+    parser.add_argument('--max_keyframes', type=int, default=32, help='Bounds the memory of the keyframes')
+    parser.add_argument('--num_steps', type=int, default=10, help='Number of evenly spaced times to report')
+    args = parser.parse_args()
+
+    initial = load_adf_volume(args.volume_adf)
+    times, indices, _ = load_removed_voxels(args.files)
+    start = time.time()
+    state = VolumeState(initial, times, indices, args.keyframe_interval, args.max_keyframes)
+    print("volume %s, %d voxels, %d removals, %d keyframes built in %.2f s" % (
+        state.shape, state.initial_count, len(times), len(state.keyframes), time.time() - start))
+
+    if len(times) == 0:
+        return
+    for t in np.linspace(times[0], times[-1], args.num_steps):
+        start = time.time()
+        occupancy = state.seek(t)
+        print("t: %10.3f removed: %8d remaining: %10d (seek %.1f ms)" % (
+            t, state.removed_count(t), np.count_nonzero(occupancy), (time.time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
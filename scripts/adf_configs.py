@@ -140,6 +140,25 @@ def sync_volumes(args):
             f.close()
 
 
+def volume_images_config(template_adf, adf_file, images_path, prefix, count, fmt='png'):
+    '''
+    write a volume adf from a template, pointing to a png stack. images_path is relative to the adf file
+    '''
+    with open(template_adf, 'r') as f:
+        params = yaml.load(f)
+    for k, _ in params.items():
+        if 'VOLUME' in k:
+            volume_name = k
+            break
+    images = params[volume_name]['images']
+    images['path'] = str(images_path).rstrip('/') + '/'
+    images['prefix'] = prefix
+    images['format'] = fmt
+    images['count'] = count
+    with open(adf_file, 'w') as f:
+        yaml.dump(params, f)
+
+
 def main(args):
     if args.fov is not None and args.focal is not None:
         raise Exception('Specify either focal length or vertical field of view angle, not both')
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import h5py
+
+from data_validation import validate_file, print_summary
+from utils import *
+
+
+def is_recording(filename):
+    """
+    False for hdf5 files without the data and metadata groups data_record.py writes (e.g. exported results), files
+    that cannot be opened are kept so that they are reported where they are processed
+    """
+    try:
+        with h5py.File(filename, 'r') as f:
+            return 'data' in f and 'metadata' in f
+    except OSError:
+        return True
+
+
+def find_recordings(paths):
+    """
+    expand files and session directories into a sorted list of hdf5 chunk files
+    """
+    files = []
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            files += [f for f in p.rglob('*.hdf5') if is_recording(f)]
+        elif p.suffix == '.hdf5':
+            files.append(p)
+    return sorted(set(f.resolve() for f in files))
+
+
+def file_key(filename, setting, block_size=1 << 20):
+    """
+    cache key from path, size, mtime and the first/last block of the file, cheap even for large recordings
+    """
+    stat = os.stat(filename)
+    sha = hashlib.sha1()
+    sha.update(("%s|%d|%d|%s" % (filename, stat.st_size, stat.st_mtime_ns, setting)).encode())
+    with open(filename, 'rb') as fp:
+        sha.update(fp.read(block_size))
+        if stat.st_size > block_size:
+            fp.seek(-block_size, os.SEEK_END)
+            sha.update(fp.read(block_size))
+    return sha.hexdigest()
+
+
+def load_cached(cache_dir, key):
+    cache_file = cache_dir / (key + '.json')
+    if not cache_file.exists():
+        return None
+    with open(cache_file, 'r') as fp:
+        return json.load(fp)
+
+
+def save_cached(cache_dir, key, summary):
+    # write then rename so that an interrupted run never leaves a truncated entry behind
+    tmp_file = cache_dir / (key + '.json.tmp')
+    with open(tmp_file, 'w') as fp:
+        json.dump(summary, fp)
+    os.replace(tmp_file, cache_dir / (key + '.json'))
+
+
+def validate_task(filename, setting, chunk_size, no_drilling, stride):
+    start = time.time()
+    try:
+        _, summary = validate_file(filename, setting, chunk_size, no_drilling=no_drilling, stride=stride)
+    except Exception as e:
+        summary = dict(file=str(filename), setting=setting, passed=False, error=repr(e))
+    summary['duration'] = time.time() - start
+    return summary
+
+
+def build_report(summaries, elapsed):
+    checked = [s for s in summaries if 'error' not in s]
+    report = dict(
+        num_files=len(summaries),
+        num_passed=sum(1 for s in summaries if s['passed']),
+        num_errors=len(summaries) - len(checked),
+        num_frames=sum(s['num_frames'] for s in checked),
+        num_failed_frames=sum(s['num_failed'] for s in checked),
+        max_error=max([s['max_error'] for s in checked], default=0.0),
+        lag=sum(s['lag'] for s in checked),
+        lead=sum(s['lead'] for s in checked),
+        elapsed=elapsed,
+        files=sorted(summaries, key=lambda s: s['file']),
+    )
+    return report
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='Recording files or session directories')
+    parser.add_argument('--setting', choices=['sphere', 'drilling'], type=str, default='drilling')
+    parser.add_argument('--no_drilling', action='store_true')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Frames loaded at once per worker')
+    parser.add_argument('--stride', type=int, default=8, help='Pixel stride of tracked points in drilling mode')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--cache_dir', type=str, default='.validation_cache', help='Directory of cached results')
+    parser.add_argument('--no_cache', action='store_true', help='Re-validate every file')
+    parser.add_argument('--report', type=str, default='validation_report.json')
+    args = parser.parse_args()
+
+    files = find_recordings(args.paths)
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    print(INFO_STR("Found %d recordings" % len(files)))
+
+    start = time.time()
+    summaries = []
+    pending = {}
+    # results depend on the options and on the relative depth tolerance of validate_file
+    setting = '%s|%s|%d|rtol' % (args.setting, args.no_drilling, args.stride)
+    for filename in files:
+        key = file_key(filename, setting)
+        cached = None if args.no_cache else load_cached(cache_dir, key)
+        if cached is not None:
+            summaries.append(cached)
+        else:
+            pending[key] = filename
+    print(INFO_STR("%d cached, %d to validate" % (len(summaries), len(pending))))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(validate_task, filename, args.setting, args.chunk_size, args.no_drilling,
+                                   args.stride): key for key, filename in pending.items()}
+        for future in as_completed(futures):
+            summary = future.result()
+            if 'error' in summary:
+                print(INFO_STR(summary['file']), FAIL_STR(summary['error']))
+            else:
+                # only successful runs are cached, failures are retried on the next invocation
+                save_cached(cache_dir, futures[future], summary)
+                print_summary(summary)
+            summaries.append(summary)
+
+    report = build_report(summaries, time.time() - start)
+    with open(args.report, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+    status = OK_STR('PASS') if report['num_passed'] == report['num_files'] else FAIL_STR('FAIL')
+    print(status, "%d/%d files passed in %.1f s, report written to %s" % (
+        report['num_passed'], report['num_files'], report['elapsed'], args.report))
+
+
+if __name__ == "__main__":
+    main()
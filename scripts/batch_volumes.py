@@ -0,0 +1,240 @@
+'''
+Converts a directory of patient NRRDs into simulator volumes. Every NRRD becomes one job, run in its own process with
+at most --workers at once, that writes the PNG stack of each requested level, its volume ADF, the nrrd_header.pkl read
+by data_record.py and a study_gui icon and entry. Jobs whose outputs are up to date are skipped.
+
+The following is an example converting every segmented NRRD of a study to 256 volumes:
+python3 batch_volumes.py --nrrd_dir ~/study_volumes --factors 2 --memory_limit 8
+'''
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
+import pickle
+import resource
+import signal
+import time
+from argparse import ArgumentParser
+
+import yaml
+from PIL import Image
+
+from adf_configs import volume_images_config
+from build_cache import SliceCache, build_key
+from nrrd_stream import NrrdStream
+from slice_writer import SliceWriter
+from utils import *
+from volume_pyramid import PyramidLevel, build_pyramid
+
+
+class VolumeJob:
+    def __init__(self, nrrd_file, args):
+        self.nrrd_file = str(nrrd_file)
+        # LT138.seg.nrrd -> LT138
+        self.name = pathlib.Path(nrrd_file).name.split('.')[0]
+        self.mode = args.mode
+        self.label_pooling = args.label_pooling
+        self.slab_size = args.slab_size
+        self.compress_level = args.compress_level
+        self.icon_dir = args.icon_dir
+
+        sizes = NrrdStream(self.nrrd_file).sizes
+        if self.mode == 'seg':
+            sizes = sizes[1:]
+        self.levels = [PyramidLevel(f, sizes, self.name, args.dst_dir, args.adf_dir, args.image_prefix)
+                       for f in sorted(set(args.factors))]
+        self.template_adf = args.template_adf
+        self.params = dict(mode=self.mode, label_pooling=self.label_pooling, compress_level=self.compress_level)
+
+    def level_key(self, level):
+        params = dict(self.params, factor=level.factor, prefix=level.prefix)
+        return build_key(self.nrrd_file, params)
+
+    def header_file(self, level):
+        return level.images_dir / 'nrrd_header.pkl'
+
+    def icon_file(self):
+        return pathlib.Path(self.icon_dir) / (self.name + '.png')
+
+    def is_up_to_date(self):
+        for level in self.levels:
+            if not level.adf_file.exists() or not self.header_file(level).exists():
+                return False
+            if not SliceCache(level.images_dir, self.level_key(level), SliceWriter(1)).is_up_to_date():
+                return False
+        return self.icon_file().exists()
+
+
+def cpu_limit_exceeded(signum, frame):
+    raise TimeoutError('CPU time limit exceeded')
+
+
+def limit_resources(memory_limit_gb, cpu_limit_s, grace_s=10):
+    if memory_limit_gb is not None:
+        limit = int(memory_limit_gb * (1 << 30))
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if cpu_limit_s is not None:
+        # the soft limit raises SIGXCPU, handled as an exception of the job. The hard limit kills the process if it
+        # is stuck in native code that never returns to the interpreter
+        used = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(used.ru_utime + used.ru_stime + cpu_limit_s)
+        signal.signal(signal.SIGXCPU, cpu_limit_exceeded)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + grace_s))
+
+
+def write_icon(job):
+    # middle slice of the lowest resolution level, composited on black
+    level = job.levels[-1]
+    im = Image.open(level.images_dir / (level.prefix + str(level.dims[2] // 2) + '.png'))
+    icon = Image.new('RGB', im.size)
+    icon.paste(im.convert('RGBA'), mask=im.convert('RGBA').split()[-1])
+    icon.thumbnail((256, 256))
+    job.icon_file().parent.mkdir(parents=True, exist_ok=True)
+    icon.save(job.icon_file())
+
+
+def convert_volume(job, memory_limit_gb=None, cpu_limit_s=None):
+    limit_resources(memory_limit_gb, cpu_limit_s)
+    start = time.time()
+    writer = SliceWriter(workers=1, compress_level=job.compress_level)
+    for level in job.levels:
+        level.images_dir.mkdir(parents=True, exist_ok=True)
+        level.writer = SliceCache(level.images_dir, job.level_key(level), writer)
+    build_pyramid(job.nrrd_file, job.levels, job.mode, job.label_pooling, job.slab_size, writer)
+
+    header = NrrdStream(job.nrrd_file).header
+    for level in job.levels:
+        level.adf_file.parent.mkdir(parents=True, exist_ok=True)
+        images_path = os.path.relpath(level.images_dir, level.adf_file.parent)
+        volume_images_config(job.template_adf, level.adf_file, images_path, level.prefix, level.dims[2])
+        with open(job.header_file(level), 'wb') as fp:
+            pickle.dump(header, fp)
+    if not job.icon_file().exists():
+        write_icon(job)
+    return job.name, time.time() - start
+
+
+def run_job(job, memory_limit_gb, cpu_limit_s, conn):
+    """
+    child process of one job, the result or the error is sent back through conn
+    """
+    try:
+        conn.send(('ok', convert_volume(job, memory_limit_gb, cpu_limit_s)))
+    except BaseException as e:
+        conn.send(('error', repr(e)))
+    finally:
+        conn.close()
+
+
+def run_jobs(jobs, workers, memory_limit_gb=None, cpu_limit_s=None):
+    """
+    Every job runs in its own process, so limits apply per job and a job killed by a signal (SIGKILL by the hard CPU
+    limit or the OOM killer) only fails itself.
+    :return: generator of (job, (name, duration) or None, error or None) in order of completion
+    """
+    pending = list(jobs)
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            job = pending.pop(0)
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_job, args=(job, memory_limit_gb, cpu_limit_s, send_conn))
+            process.start()
+            send_conn.close()
+            running[process.sentinel] = (job, process, recv_conn)
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            job, process, recv_conn = running.pop(sentinel)
+            process.join()
+            try:
+                status, value = recv_conn.recv()
+            except EOFError:
+                # the process died before it could report
+                status, value = None, None
+            recv_conn.close()
+            if status == 'ok':
+                yield job, value, None
+            elif status == 'error':
+                yield job, None, value
+            else:
+                yield job, None, 'killed by %s' % signal.Signals(-process.exitcode).name if process.exitcode < 0 \
+                    else 'exited with %d' % process.exitcode
+
+
+def add_gui_entries(gui_setup_file, jobs):
+    '''
+    add a study_gui volume entry for every level ADF that is not listed yet
+    '''
+    gui_setup_file = pathlib.Path(gui_setup_file)
+    with open(gui_setup_file, 'r') as f:
+        params = yaml.safe_load(f)
+    gui_dir = gui_setup_file.parent.resolve()
+    listed = [pathlib.Path(gui_dir / params[v]['adf_path']).resolve() for v in params['volumes']]
+    num_volumes = max([int(k[len('volume'):]) for k in params if k.startswith('volume') and k != 'volumes'] + [0])
+    for job in jobs:
+        for level in job.levels:
+            if level.adf_file.resolve() in listed:
+                continue
+            num_volumes += 1
+            key = 'volume' + str(num_volumes)
+            params[key] = dict(adf_path=os.path.relpath(level.adf_file.resolve(), gui_dir),
+                               icon_path=os.path.join('.', os.path.relpath(job.icon_file().resolve(), gui_dir)),
+                               name='Anatomy ' + job.name + ('' if len(job.levels) == 1 else ' ' + str(level.dims[0])))
+            params['volumes'].append(key)
+            print('Added ', key, ' to ', gui_setup_file)
+    with open(gui_setup_file, 'w') as f:
+        yaml.dump(params, f)
+
+
+def main():
+    resolved_path = pathlib.Path(os.path.dirname(__file__)).resolve()
+
+    parser = ArgumentParser()
+    parser.add_argument('--nrrd_dir', type=str, required=True, help='Directory of NRRD files, one volume each')
+    parser.add_argument('--pattern', type=str, default='*.nrrd')
+    parser.add_argument('--mode', choices=['seg', 'intensity'], default='seg')
+    parser.add_argument('--factors', type=int, nargs='+', default=[2], help='Reduction factor of each level')
+    parser.add_argument('--label_pooling', choices=['majority', 'max'], default='majority')
+    parser.add_argument('-p', action='store', dest='image_prefix', help='Specify Image Prefix', default='plane00')
+    parser.add_argument('--dst_dir', type=str, default=str(resolved_path / '../resources/volumes'))
+    parser.add_argument('--adf_dir', type=str, default=str(resolved_path / '../ADF'))
+    parser.add_argument('--template_adf', type=str, default=str(resolved_path / '../ADF/volume_256.yaml'))
+    parser.add_argument('--icon_dir', type=str, default=str(resolved_path / 'study_gui/assets'))
+    parser.add_argument('--gui_setup', type=str, default=str(resolved_path / 'study_gui/gui_setup.yaml'),
+                        help='study_gui setup to add the volumes to, None to skip')
+    parser.add_argument('--slab_size', type=int, default=4, help='Number of z blocks processed at once')
+    parser.add_argument('--compress_level', type=int, default=6, help='PNG compression level [0-9], lower is faster')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of volumes converted at once')
+    parser.add_argument('--memory_limit', type=float, default=None, help='Address space limit per job in GB')
+    parser.add_argument('--cpu_limit', type=float, default=None, help='CPU time limit per job in seconds')
+    parser.add_argument('--force', action='store_true', help='Convert even if the outputs are up to date')
+    args = parser.parse_args()
+
+    nrrd_files = sorted(pathlib.Path(args.nrrd_dir).glob(args.pattern))
+    jobs, failed = [], []
+    for nrrd_file in nrrd_files:
+        try:
+            jobs.append(VolumeJob(nrrd_file, args))
+        except ValueError as e:
+            # the pyramid is built by streaming, which rejects e.g. ascii encoded NRRDs
+            name = nrrd_file.name.split('.')[0]
+            print(FAIL_STR(name), e)
+            failed.append(name)
+    pending = [job for job in jobs if args.force or not job.is_up_to_date()]
+    print(INFO_STR('%d volumes, %d up to date' % (len(jobs), len(jobs) - len(pending))))
+
+    for job, result, error in run_jobs(pending, args.workers, args.memory_limit, args.cpu_limit):
+        if error is None:
+            print(OK_STR(result[0]), 'converted in %.1f s' % result[1])
+        else:
+            # MemoryError, exceeded CPU time or a killed process only fail this job, the remaining jobs continue
+            print(FAIL_STR(job.name), error)
+            failed.append(job.name)
+
+    if args.gui_setup != 'None':
+        add_gui_entries(args.gui_setup, [job for job in jobs if job.name not in failed])
+    if len(failed) > 0:
+        print(FAIL_STR('%d volumes failed: ' % len(failed)), ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
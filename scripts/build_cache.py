@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_digest(filename, block_size=1 << 22):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def build_key(nrrd_file, params):
+    """
+    key of a whole build, the input NRRD content plus every conversion parameter
+    """
+    sha = hashlib.sha1(file_digest(nrrd_file).encode())
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def slice_digest(array, encode_params):
+    sha = hashlib.blake2b(digest_size=20)
+    sha.update(json.dumps([array.shape, str(array.dtype), encode_params]).encode())
+    sha.update(np.ascontiguousarray(array).data)
+    return sha.hexdigest()
+
+
+class SliceCache:
+    """
+    Incremental writer for a PNG stack. A manifest next to the images records the build key and the content hash of
+    every slice, so only slices whose content changed are handed to the wrapped SliceWriter (which replaces files
+    atomically). Slices of a previous build that are not produced again are removed on close.
+    """
+    def __init__(self, dst_path, key, writer):
+        self.dst_path = Path(dst_path)
+        self.key = key
+        self.writer = writer
+        self.encode_params = [writer.compress_level, writer.optimize]
+        self.manifest_file = self.dst_path / MANIFEST_NAME
+        self.manifest = dict(build_key=None, slices={})
+        if self.manifest_file.exists():
+            with open(self.manifest_file, 'r') as fp:
+                self.manifest = json.load(fp)
+        self._slices = {}
+        self.num_written = 0
+        self.num_skipped = 0
+
+    def is_up_to_date(self):
+        if self.manifest['build_key'] != self.key:
+            return False
+        return all((self.dst_path / name).exists() for name in self.manifest['slices'])
+
+    def save(self, array, im_name):
+        name = os.path.relpath(im_name, self.dst_path)
+        digest = slice_digest(array, self.encode_params)
+        self._slices[name] = digest
+        if self.manifest['slices'].get(name) == digest and (self.dst_path / name).exists():
+            self.num_skipped += 1
+            return
+        self.writer.save(array, im_name)
+        self.num_written += 1
+
+    def close(self):
+        self.writer.close()
+        for name in set(self.manifest['slices']) - set(self._slices):
+            stale = self.dst_path / name
+            if stale.exists():
+                stale.unlink()
+        self.manifest = dict(build_key=self.key, slices=self._slices)
+        tmp_file = self.manifest_file.with_name(MANIFEST_NAME + '.tmp')
+        with open(tmp_file, 'w') as fp:
+            json.dump(self.manifest, fp, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+        print('Slices written: ', self.num_written, ' unchanged: ', self.num_skipped)
@@ -6,7 +6,7 @@ import pickle
 import sys
 import time
 from argparse import ArgumentParser
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from threading import Thread, Lock
 
 import h5py
@@ -26,6 +26,9 @@ from ambf_msgs.msg import RigidBodyState, CameraState
 from cv_bridge import CvBridge, CvBridgeError
 from sensor_msgs.msg import Image, PointCloud2
 from geometry_msgs.msg import WrenchStamped
+from std_msgs.msg import Float32MultiArray, MultiArrayDimension
+
+from distance_fields import DistanceFields
 
 try:
     from volumetric_drilling_msgs.msg import Voxels, DrillSize, VolumeInfo
@@ -52,6 +55,15 @@ def rpy_to_quat(roll, pitch, yaw):
     return x, y, z, w
 
 
+def quat_rotate(quat, vec):
+    """
+    rotate vectors by quaternions [qx, qy, qz, qw], both Nx.. and broadcastable
+    """
+    q_xyz = quat[..., :3]
+    t = 2.0 * np.cross(q_xyz, vec)
+    return vec + quat[..., 3:] * t + np.cross(q_xyz, t)
+
+
 def depth_gen(depth_msg):
     """
     generate depth
@@ -181,6 +193,10 @@ def init_hdf5(args):
     file.create_group("voxels_removed")
     file.create_group("burr_change")
     file.create_group("drill_force_feedback")
+    if args.track_removed_volume:
+        file.create_group("removed_volume")
+    if distance_fields is not None:
+        file.create_group("proximity")
 
     return file, img_height, img_width, s, volume_pose
 
@@ -218,6 +234,7 @@ def callback(*inputs):
 
 
 def write_to_hdf5():
+    global voxel_lock
     try:
         hdf5_vox_vol = f["metadata"].create_dataset("voxel_volume", data=voxel_volume)
         hdf5_vox_vol.attrs["units"] = "mm^3, millimeters cubed"
@@ -229,6 +246,17 @@ def write_to_hdf5():
     ##################################
     #### Save img data and burr_change
     containers = [(f["data"], container), (f["burr_change"], burr_change), (f["drill_force_feedback"], drill_force_feedback)]
+    if args.track_removed_volume:
+        voxel_lock.acquire()
+        containers.append((f["removed_volume"], OrderedDict((k, v) for k, v in removed_volume.items())))
+        for key in removed_volume.keys():
+            removed_volume[key] = []
+        voxel_lock.release()
+        f["removed_volume"].attrs["units"] = "volume in mm^3, millimeters cubed"
+    if distance_fields is not None:
+        containers.append((f["proximity"], proximity))
+        f["proximity"].attrs["segments"] = distance_fields.names
+        f["proximity"].attrs["units"] = "tip_position in meters (world), distance in mm to each segment"
     for group, data in containers:
         for key, value in data.items():
             if len(value) > 0:
@@ -246,7 +274,6 @@ def write_to_hdf5():
     voxel_color = []
     voxel_ts = []
 
-    global voxel_lock
     voxel_lock.acquire()
     ###
 
@@ -325,6 +352,8 @@ def timer_callback():
                 container[key].append(data)
 
             num_data = num_data + 1
+            if distance_fields is not None:
+                update_proximity()
             if num_data >= chunk:
                 log.log(logging.INFO, "\nWrite data to disk")
                 write_to_hdf5()
@@ -332,10 +361,17 @@ def timer_callback():
                 num_data = 0
         except Empty:
             log.log(logging.NOTSET, "Empty queue")
+            if distance_fields is not None:
+                update_proximity()
 
         time.sleep(0.002)
 
     # Write one more time for any data that hasn't been saved
+    if distance_fields is not None:
+        update_proximity()
+    if len(pending_removals):
+        log.log(logging.WARNING, "Volume info never received, %d removed voxels not tracked in removed volume" %
+                sum(len(indices) for _, indices in pending_removals))
     write_to_hdf5()
 
     finished_recording = True
@@ -359,9 +395,81 @@ def rm_vox_callback(rm_vox_msg):
     collisions["voxel_time_stamp"].append(rm_vox_msg.header.stamp.to_sec())
     collisions["voxel_removed"].append(voxels_indices)
     collisions["voxel_color"].append(voxels_colors)
+
+    if args.track_removed_volume and len(voxels_indices) > 0:
+        update_removed_volume(rm_vox_msg.header.stamp.to_sec(), voxels_indices)
     voxel_lock.release()
 
 
+def update_removed_volume(time_stamp, voxels_indices):
+    """
+    mark voxels in the removed bitset and append the cumulative removed volume, called with voxel_lock held
+    """
+    global removed_voxel_count
+    if removed_bitset is None:
+        # the grid is not known yet, replayed by volume_prop_callback
+        pending_removals.append((time_stamp, voxels_indices))
+        return
+
+    flat = np.ravel_multi_index(voxels_indices.T.astype(np.int64), volume_voxel_count, mode="clip")
+    # same bit order as np.packbits
+    byte = flat >> 3
+    bit = (7 - (flat & 7)).astype(np.uint8)
+    new = np.unique(flat[((removed_bitset[byte] >> bit) & 1) == 0])
+    np.bitwise_or.at(removed_bitset, new >> 3, (1 << (7 - (new & 7))).astype(np.uint8))
+    removed_voxel_count = removed_voxel_count + len(new)
+
+    removed_volume["time_stamp"].append(time_stamp)
+    removed_volume["voxel_count"].append(removed_voxel_count)
+    removed_volume["volume"].append(removed_voxel_count * voxel_volume)
+
+
+def drill_pose_callback(pose_msg):
+    # only queued here, distances are looked up in batches by the timer thread
+    proximity_pending.append((pose_msg.header.stamp.to_sec(), pose_gen(pose_msg)))
+
+
+def drill_tip_voxels(poses):
+    """
+    drill tip of Nx7 world poses as (fractional) voxel coordinates of the distance fields
+    """
+    tip = poses[:, :3] + quat_rotate(poses[:, 3:], np.asarray(args.drill_tip_offset) * scale)
+    # T_volume_world
+    tip_volume = quat_rotate(volume_pose[3:] * [-1, -1, -1, 1], tip - volume_pose[:3])
+    field_count = np.array(distance_fields.shape)
+    if volume_dimensions is None:
+        # volume info not received yet, assume the volume is sized as the segmented anatomy
+        voxel_size = distance_fields.spacing_mm / 1000.0
+    else:
+        voxel_size = np.asarray(volume_dimensions) * scale / field_count
+    # the volume is centered on its pose
+    return tip_volume / voxel_size + field_count / 2.0 - 0.5, tip
+
+
+def update_proximity():
+    """
+    look up the distance of every queued drill pose to each segment, record them and publish the latest
+    """
+    num_pending = len(proximity_pending)
+    if num_pending == 0:
+        return
+    samples = [proximity_pending.popleft() for _ in range(num_pending)]
+    time_stamps = np.array([sample[0] for sample in samples])
+    poses = np.stack([sample[1] for sample in samples], axis=0)
+
+    voxels, tips = drill_tip_voxels(poses)
+    distances = distance_fields.lookup(voxels)
+    proximity["time_stamp"].extend(time_stamps)
+    proximity["tip_position"].extend(tips)
+    proximity["distance"].extend(distances)
+
+    msg = Float32MultiArray()
+    msg.layout.dim = [MultiArrayDimension(label=",".join(distance_fields.names), size=len(distance_fields.names),
+                                          stride=len(distance_fields.names))]
+    msg.data = distances[-1].tolist()
+    proximity_pub.publish(msg)
+
+
 def drill_force_feedback_callback(wrench_msg):
     wrench = [wrench_msg.wrench.force.x, wrench_msg.wrench.force.y, wrench_msg.wrench.force.z,
               wrench_msg.wrench.torque.x, wrench_msg.wrench.torque.y, wrench_msg.wrench.torque.z]
@@ -376,12 +484,22 @@ def burr_change_callback(burr_change_msg):
 
 
 def volume_prop_callback(volume_prop_msg):
-    global voxel_volume
+    global voxel_volume, removed_bitset, volume_voxel_count, volume_dimensions
     dimensions = volume_prop_msg.dimensions
+    volume_dimensions = tuple(dimensions)
     voxel_count = volume_prop_msg.voxel_count
     resolution = np.divide(dimensions, voxel_count) * 1000
     voxel_volume = np.prod(resolution) * scale ** 3
 
+    if args.track_removed_volume:
+        voxel_lock.acquire()
+        if removed_bitset is None or tuple(voxel_count) != volume_voxel_count:
+            volume_voxel_count = tuple(int(c) for c in voxel_count)
+            removed_bitset = np.zeros((int(np.prod(volume_voxel_count)) + 7) // 8, dtype=np.uint8)
+        while len(pending_removals):
+            update_removed_volume(*pending_removals.popleft())
+        voxel_lock.release()
+
 
 def setup_subscriber(args):
     active_topics = [n for [n, _] in rospy.get_published_topics()]
@@ -468,6 +586,18 @@ def setup_subscriber(args):
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.force_topic)
             exit()
 
+    if distance_fields is not None:
+        topic = "/ambf/env/" + args.drill_name + "/State"
+        if topic in active_topics:
+            # full pose rate, independent of the synchronized frames
+            rospy.Subscriber(topic, RigidBodyState, drill_pose_callback, queue_size=100)
+            proximity["time_stamp"] = []
+            proximity["tip_position"] = []
+            proximity["distance"] = []
+        else:
+            log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + topic)
+            exit()
+
     # poses
     for name in args.objects:
         if "camera" in name:
@@ -495,6 +625,9 @@ def main(args):
     # setup ros node and subscribers
     rospy.init_node("data_recorder")
     subscribers = setup_subscriber(args)
+    if distance_fields is not None:
+        global proximity_pub
+        proximity_pub = rospy.Publisher(args.proximity_topic, Float32MultiArray, queue_size=10)
 
     print("Synchronous? : ", args.sync)
     # NOTE: don't set queue size to a large number (e.g. 1000).
@@ -571,6 +704,20 @@ if __name__ == "__main__":
     #fmt: on
 
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--track_removed_volume", action="store_true",
+        help="Keep a bitset of removed voxels and record the cumulative removed volume over time"
+    )
+    parser.add_argument(
+        "--distance_fields", default=None, type=str,
+        help="distance_fields.npz of the loaded volume, enables recording the drill tip distance to each segment"
+    )
+    parser.add_argument("--drill_name", default="mastoidectomy_drill", type=str)
+    parser.add_argument(
+        "--drill_tip_offset", default=[0.0, 0.0, 0.0], type=float, nargs=3,
+        help="Drill tip in the drill frame, simulation units"
+    )
+    parser.add_argument("--proximity_topic", default="/data_recorder/drill_proximity", type=str)
 
     args = parser.parse_args()
     print("Provided args: \n", args)
@@ -605,6 +752,11 @@ if __name__ == "__main__":
     finished_recording = True
     voxel_lock = Lock()
 
+    distance_fields = None
+    if args.distance_fields is not None:
+        distance_fields = DistanceFields.load(args.distance_fields)
+        print("Drill proximity to: ", ", ".join(distance_fields.names))
+
     f, h, w, scale, volume_pose = init_hdf5(args)
 
     # initialize queue for multi-threading
@@ -616,5 +768,14 @@ if __name__ == "__main__":
     burr_change = OrderedDict()
     drill_force_feedback = OrderedDict()
     voxel_volume = 0
+    removed_volume = OrderedDict(time_stamp=[], voxel_count=[], volume=[])
+    removed_bitset = None
+    removed_voxel_count = 0
+    pending_removals = deque()
+    volume_voxel_count = None
+    volume_dimensions = None
+    proximity = OrderedDict()
+    proximity_pending = deque()
+    proximity_pub = None
 
     main(args)
@@ -3,53 +3,27 @@ from argparse import ArgumentParser
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.spatial.transform import Rotation as R
 
+from projection import ray_grid
+from segm_classes import DEFAULT_PALETTE, DRILL_COLOR, MASTOID_COLOR, SegmClassifier
+from transform_tree import CV, TransformTree, invert_transform
 from utils import *
 
-
-def quaternion_multiply(q1, q2):
-    """
-    rotation multiplication as quaternion
-    """
-    x1, y1, z1, w1 = np.split(q1, 4, axis=-1)
-    x2, y2, z2, w2 = np.split(q2, 4, axis=-1)
-    w = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
-    x = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
-    y = w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2
-    z = w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
-    return np.concatenate([x, y, z, w], axis=-1)
+SEGM_CLASSES = SegmClassifier(DEFAULT_PALETTE)
 
 
 def verify_xyz(depth, K):
     h, w = depth.shape[1:3]
-    u, v = np.meshgrid(np.arange(0, w), np.arange(0, h))
-    uv = np.stack([u, v], axis=-1)
-    uv_one = np.concatenate([uv, np.ones([h, w, 1])], axis=-1)[None]  # 1xHxWx3
-    uvz = uv_one * depth[..., -1][..., None]  # NxHxWx3
-    K_inv = np.linalg.inv(K)  # 3x3
-    xyz = np.einsum('ab,nhwb->nhwa', K_inv, uvz)
+    xyz = ray_grid(K, h, w)[None] * depth[..., -1:]  # NxHxWx3
 
     assert np.all(np.isclose(xyz, depth, rtol=0.01, atol=1e-3)
                   ), "Analytical result doesn't match emperical result"
 
 
-def pose_to_matrix(pose):
-    quat_norm = np.linalg.norm(pose[:, 3:], axis=-1)
-    assert np.all(np.isclose(quat_norm, 1.0))
-    r = R.from_quat(pose[:, 3:]).as_matrix()
-    t = pose[:, :3]
-    tau = np.identity(4)[None].repeat(pose.shape[0], axis=0)
-    tau[:, :3, :3] = r
-    tau[:, :3, -1] = t
-
-    return tau
-
-
 def verify_sphere(depth, K, RT, pose_cam, pose_primitive, time_stamps):
     # simple test, querying a point on the sphere
     query_point = np.array([1, 0, 0, 1])[None, :, None]  # homo, Nx4x1
-    query_point_c = np.linalg.inv(pose_cam) @ (pose_primitive @ query_point)
+    query_point_c = invert_transform(pose_cam) @ (pose_primitive @ query_point)
     query_point_c = RT @ query_point_c
     uvz = K @ query_point_c[..., :3, :]
     u = np.rint((uvz[..., 0, :] / uvz[..., -1, :]).squeeze()).astype(int)
@@ -154,29 +128,211 @@ def pose_depth_test(K, pose, depth, segm, u, v, target_color):
             v = v_new
 
 
+def iter_chunks(num_frames, chunk_size):
+    for start in range(0, num_frames, chunk_size):
+        yield start, min(start + chunk_size, num_frames)
+
+
+def sphere_errors(depth, K, RT, pose_cam, pose_primitive):
+    """
+    batched version of the projection in verify_sphere
+    :return: analytical z, measured z (nan when projected outside of image), validity mask; all of shape N
+    """
+    query_point = np.array([1, 0, 0, 1])[None, :, None]  # homo, Nx4x1
+    query_point_c = RT @ (invert_transform(pose_cam) @ (pose_primitive @ query_point))
+    uvz = (K @ query_point_c[..., :3, :])[..., 0]  # Nx3
+    z = uvz[:, 2]
+    in_front = z > 0
+    z_safe = np.where(in_front, z, 1.0)
+    u = np.where(in_front, np.rint(uvz[:, 0] / z_safe), -1).astype(int)
+    v = np.where(in_front, np.rint(uvz[:, 1] / z_safe), -1).astype(int)
+
+    h, w = depth.shape[1:3]
+    valid = in_front & (0 <= u) & (u < w) & (0 <= v) & (v < h)
+    z_mea = np.full(z.shape, np.nan)
+    idx = np.flatnonzero(valid)
+    z_mea[idx] = depth[idx, v[idx], u[idx]]
+
+    return z, z_mea, valid
+
+
+def drilling_errors(K, poses, depth, target, stride=8):
+    """
+    batched version of pose_depth_test, every stride-th pixel of the target class in frame i is back-projected,
+    moved by the relative pose and compared against the depth of frame i + 1
+    :param poses: Nx4x4, T_cam_obj, target: NxHxW pixels of the target class
+    :return: per frame pair median abs depth error and median error relative to the measured depth (N - 1),
+    validity mask (N - 1), depth unchanged mask (N - 1)
+    """
+    num_pairs = depth.shape[0] - 1
+    h, w = depth.shape[1:3]
+    error = np.full(num_pairs, np.nan)
+    rel_error = np.full(num_pairs, np.nan)
+    valid = np.zeros(num_pairs, dtype=bool)
+    stale = np.zeros(num_pairs, dtype=bool)
+    if num_pairs < 1:
+        return error, rel_error, valid, stale
+
+    moved = ~np.all(np.isclose(poses[1:], poses[:-1]), axis=(1, 2))
+    stale = np.all(depth[1:] == depth[:-1], axis=(1, 2))
+
+    rays = ray_grid(K, h, w, stride)
+    d = depth[:-1, ::stride, ::stride].astype(np.float64)  # PxHsxWs
+    X0 = rays[None] * d[..., None]
+
+    d_pose = poses[1:] @ invert_transform(poses[:-1])  # T_j,ct @ T_i,tc
+    X1 = np.einsum('pab,phwb->phwa', d_pose[:, :3, :3], X0) + d_pose[:, None, None, :3, -1]
+    uvz = np.einsum('ab,phwb->phwa', K, X1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u_new = np.rint(uvz[..., 0] / uvz[..., 2])
+        v_new = np.rint(uvz[..., 1] / uvz[..., 2])
+
+    tracked = target[:-1, ::stride, ::stride] & (d > 0) & (uvz[..., 2] > 0)
+    tracked &= (0 <= u_new) & (u_new < w) & (0 <= v_new) & (v_new < h)
+    p, i, j = np.nonzero(tracked)
+    u_new = u_new[p, i, j].astype(int)
+    v_new = v_new[p, i, j].astype(int)
+    still_target = target[p + 1, v_new, u_new]
+    p, i, j = p[still_target], i[still_target], j[still_target]
+    d_mea = depth[p + 1, v_new[still_target], u_new[still_target]].astype(np.float64)
+    err = np.abs(uvz[p, i, j, 2] - d_mea)
+    # relative to the measured depth, as np.isclose(z, d_new, rtol) in pose_depth_test
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel = err / np.abs(d_mea)
+
+    # per pair median from one sort of all tracked points
+    counts = np.bincount(p, minlength=num_pairs)
+    valid = moved & (counts > 0)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    pairs = np.flatnonzero(valid)
+    lo = offsets[pairs] + (counts[pairs] - 1) // 2
+    hi = offsets[pairs] + counts[pairs] // 2
+    for values, out in ((err, error), (rel, rel_error)):
+        values = values[np.lexsort((values, p))]
+        out[pairs] = 0.5 * (values[lo] + values[hi])
+
+    return error, rel_error, valid, stale
+
+
+def summarize_errors(error, valid, failed, lag, lead):
+    summary = dict(
+        num_frames=int(error.shape[0]),
+        num_checked=int(np.count_nonzero(valid)),
+        num_failed=int(np.count_nonzero(failed)),
+        max_error=float(np.nanmax(np.abs(error))) if np.any(valid) else 0.0,
+        mean_error=float(np.nanmean(np.abs(error))) if np.any(valid) else 0.0,
+        lag=int(np.count_nonzero(lag)),
+        lead=int(np.count_nonzero(lead)),
+    )
+    summary['passed'] = summary['num_failed'] == 0
+    return summary
+
+
+def validate_file(filename, setting='drilling', chunk_size=100, rtol=0.01, no_drilling=False, stride=8):
+    """
+    headless validation of one recording, reads the file chunk by chunk and checks every frame. A frame fails when its
+    depth error relative to the measured depth reaches rtol, as in the interactive checks
+    :return: dict of per frame arrays (time, error, valid, failed, lag, lead) and a summary dict
+    """
+    f = h5py.File(filename, 'r')
+    intrinsic = f['metadata']['camera_intrinsic'][()]
+    extrinsic = f['metadata']['camera_extrinsic'][()]
+    time_stamps = f['data']['time'][()]
+    num_frames = time_stamps.shape[0]
+
+    error = np.full(num_frames, np.nan)
+    valid = np.zeros(num_frames, dtype=bool)
+    failed = np.zeros(num_frames, dtype=bool)
+    stale = np.zeros(num_frames, dtype=bool)
+
+    if setting == 'sphere':
+        z_mea = np.full(num_frames, np.nan)
+        for start, end in iter_chunks(num_frames, chunk_size):
+            tree = TransformTree.from_recording(f, start, end)
+            pose_cam = tree.lookup('world', CV)
+            pose_sphere = tree.lookup('world', 'Sphere')
+            depth = f['data']['depth'][start:end]
+            z, z_mea[start:end], valid[start:end] = sphere_errors(depth, intrinsic, extrinsic, pose_cam, pose_sphere)
+            error[start:end] = z - z_mea[start:end]
+            close = np.isclose(z, z_mea[start:end], rtol=rtol)
+            failed[start:end] = valid[start:end] & ~close
+
+        # a failing frame is lagging when its depth did not change since the previous valid frame
+        off = failed.copy()
+        z_valid = z_mea[valid]
+        same_as_prev = np.concatenate([[False], z_valid[1:] == z_valid[:-1]])
+        stale[valid] = same_as_prev
+        off[np.flatnonzero(valid)[:1]] = False
+    else:
+        rel_error = np.full(num_frames, np.nan)
+        targets = ['drill']
+        if no_drilling:
+            targets.append('mastoid')
+        # consecutive chunks overlap by one frame so that every frame pair is checked once
+        for start, end in iter_chunks(max(num_frames - 1, 0), chunk_size):
+            end = end + 1
+            tree = TransformTree.from_recording(f, start, end)
+            depth = f['data']['depth'][start:end]
+            # one lookup classifies the chunk for all targets
+            labels = SEGM_CLASSES.labels(f['data']['segm'][start:end])
+            for target in targets:
+                if target == 'mastoid':
+                    poses = tree.lookup(CV, 'mastoidectomy_volume')  # T_ct
+                else:
+                    poses = tree.lookup(CV, 'mastoidectomy_drill')
+                e, rel, ok, st = drilling_errors(intrinsic, poses, depth, labels == SEGM_CLASSES.class_id(target),
+                                                 stride)
+                # report the worst target per frame
+                pair = slice(start + 1, end)
+                error[pair] = np.fmax(error[pair], np.where(ok, e, np.nan))
+                rel_error[pair] = np.fmax(rel_error[pair], np.where(ok, rel, np.nan))
+                valid[pair] |= ok
+                stale[pair] = st
+        failed = valid & (np.nan_to_num(rel_error) >= rtol)
+        off = failed
+    f.close()
+
+    lag = off & stale
+    lead = off & ~stale
+    summary = summarize_errors(error, valid, failed, lag, lead)
+    summary['file'] = str(filename)
+    summary['setting'] = setting
+
+    return dict(time=time_stamps, error=error, valid=valid, failed=failed, lag=lag, lead=lead), summary
+
+
+def print_summary(summary):
+    status = OK_STR('PASS') if summary['passed'] else FAIL_STR('FAIL')
+    print(INFO_STR(summary['file']), status,
+          "frames: %d checked: %d failed: %d" % (summary['num_frames'], summary['num_checked'], summary['num_failed']),
+          "max err: " + toStr(summary['max_error']), "mean err: " + toStr(summary['mean_error']),
+          WARN_STR("LAG: %d" % summary['lag']), WARN2_STR("LEAD: %d" % summary['lead']))
+
+
 def verify_drilling(K, pose_cam, pose_drill, segm, depth):
+    labels = SEGM_CLASSES.labels(segm[:1])[0]
     # tool
-    tool = np.all(segm[0] == np.array([33, 32, 34]), axis=-1)
+    tool = labels == SEGM_CLASSES.class_id('drill')
     y, x = np.where(tool)
     while True:
         u = np.random.randint(np.min(x), np.max(x))
         v = np.random.randint(np.min(y), np.max(y))
         if tool[v, u]:
             break
-    poses = np.linalg.inv(pose_cam) @ pose_drill  # T_cw @ T_wt = T_ct
-    pose_depth_test(K, poses, depth, segm, u, v, target_color=np.array([33, 32, 34]))
+    poses = invert_transform(pose_cam) @ pose_drill  # T_cw @ T_wt = T_ct
+    pose_depth_test(K, poses, depth, segm, u, v, target_color=DRILL_COLOR)
 
     if args.no_drilling:
         # mastoid (only valid when there is no drilling)
-        mastoid = np.all(segm[0] == np.array([219, 249, 255]), axis=-1)
+        mastoid = labels == SEGM_CLASSES.class_id('mastoid')
         y, x = np.where(mastoid)
         while True:
             u = np.random.randint(np.min(x), np.max(x))
             v = np.random.randint(np.min(y), np.max(y))
             if mastoid[v, u]:
                 break
-        poses = np.linalg.inv(pose_cam) @ pose_patient  # T_cw @ T_wt = T_ct
-        pose_depth_test(K, poses, depth, segm, u, v, target_color=np.array([219, 249, 255]))
+        poses = invert_transform(pose_cam) @ pose_patient  # T_cw @ T_wt = T_ct
+        pose_depth_test(K, poses, depth, segm, u, v, target_color=MASTOID_COLOR)
     print("All test passed :)")
     return
 
@@ -186,31 +342,38 @@ if __name__ == "__main__":
     parser.add_argument('--setting', choices=['sphere', 'drilling'], type=str, default='drilling')
     parser.add_argument('--file', type=str, default=None)
     parser.add_argument('--no_drilling', action='store_true')
+    parser.add_argument('--headless', action='store_true', help='Check every frame in chunks without plotting')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Frames loaded at once in headless mode')
+    parser.add_argument('--stride', type=int, default=8, help='Pixel stride of tracked points in headless drilling mode')
+    parser.add_argument('--output', type=str, default=None, help='Save per frame errors of headless mode as npz')
 
     np.set_printoptions(suppress=True, formatter={'float_kind': '{:f}'.format})
     np.random.seed(32)
 
     args = parser.parse_args()
-    if args.file is not None:
+    if args.file is not None and args.headless:
+        frames, summary = validate_file(args.file, args.setting, args.chunk_size, no_drilling=args.no_drilling,
+                                        stride=args.stride)
+        print_summary(summary)
+        if args.output is not None:
+            np.savez_compressed(args.output, **frames)
+    elif args.file is not None:
         f = h5py.File(args.file, 'r')
         intrinsic = f['metadata']['camera_intrinsic'][()]
         extrinsic = f['metadata']['camera_extrinsic'][()]
-        extrinsic_quat_inv = R.from_matrix(np.linalg.inv(extrinsic)[:3, :3]).as_quat()
 
         depth = f['data']['depth'][()]
         time_stamps = f['data']['time'][()]
 
-        pose_cam = f['data']['pose_main_camera'][()]
-        # apply extrinsic inv to camera poses
-        pose_cam[:, 3:] = quaternion_multiply(pose_cam[:, 3:], extrinsic_quat_inv)
-        pose_cam = pose_to_matrix(pose_cam)
+        tree = TransformTree.from_recording(f)
+        pose_cam = tree.lookup('world', CV)
 
         if args.setting == 'sphere':
-            pose_sphere = pose_to_matrix(f['data']['pose_Sphere'][()])
+            pose_sphere = tree.lookup('world', 'Sphere')
             verify_sphere(depth, intrinsic, extrinsic, pose_cam, pose_sphere, time_stamps)
         elif args.setting == 'drilling':
             segm = f['data']['segm'][()]
             limg = f['data']['l_img'][()]
-            pose_drill = pose_to_matrix(f['data']['pose_mastoidectomy_drill'][()])
-            pose_patient = pose_to_matrix(f['data']['pose_mastoidectomy_volume'][()])
+            pose_drill = tree.lookup('world', 'mastoidectomy_drill')
+            pose_patient = tree.lookup('world', 'mastoidectomy_volume')
             verify_drilling(intrinsic, pose_cam, pose_drill, segm, depth)
@@ -18,24 +18,13 @@ import rospy
 from ambf_msgs.msg import RigidBodyState
 from cv_bridge import CvBridge, CvBridgeError
 from sensor_msgs.msg import Image, PointCloud2
+from transform_tree import pose_to_matrix
 from utils import *
-from scipy.spatial.transform import Rotation as R
 from geometry_msgs.msg import PoseStamped
 
 global intrinsic
 
 
-def pose_to_matrix(pose):
-    quat_norm = np.linalg.norm(pose[3:])
-    assert np.isclose(quat_norm, 1.0)
-    r = R.from_quat(pose[3:]).as_matrix()
-    t = pose[:3]
-    tau = np.identity(4)
-    tau[:3, :3] = r
-    tau[:3, -1] = t
-    return tau
-
-
 def depth_gen(depth_msg):
     """
     generate depth
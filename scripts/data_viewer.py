@@ -1,4 +1,12 @@
+import hashlib
+import os
+import time
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock, Thread
 
 import cv2
 import h5py
@@ -7,22 +15,228 @@ import numpy as np
 from scipy.spatial.transform import Rotation as R
 from tqdm import tqdm
 
-from data_validation import pose_to_matrix
+from data_validation import iter_chunks
+from transform_tree import CV, TransformTree
+
+PANELS = ['l_img', 'r_img', 'depth', 'segm']
+
+
+def preview_path(filename, preview_dir):
+    # kept out of the recording directories, where it would be picked up as a recording. The path hash keeps
+    # recordings of the same name in different sessions apart
+    digest = hashlib.sha1(str(Path(filename).resolve()).encode()).hexdigest()[:12]
+    return Path(preview_dir) / (Path(filename).stem + '_' + digest + '_preview.hdf5')
+
+
+def downsample(name, data, factor):
+    if name == 'segm':
+        # nearest keeps the class colors
+        return data[:, ::factor, ::factor]
+    size = (data.shape[2] // factor, data.shape[1] // factor)
+    if name == 'depth':
+        data = data.astype(np.float32)
+    small = np.stack([cv2.resize(d, size, interpolation=cv2.INTER_AREA) for d in data], axis=0)
+    return small.astype(np.float16) if name == 'depth' else small
+
+
+def build_previews(filename, preview_dir, factors=(4,), chunk_size=32):
+    """
+    downsampled copies of the image datasets of a recording in preview_dir, one group per factor, all levels written
+    from a single read. Chunks hold chunk_size whole frames and use the fast lzf filter
+    """
+    out_file = preview_path(filename, preview_dir)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    if out_file.exists() and out_file.stat().st_mtime >= Path(filename).stat().st_mtime:
+        return out_file
+    tmp_file = out_file.with_name(out_file.name + '.tmp')
+    with h5py.File(filename, 'r') as f, h5py.File(tmp_file, 'w') as out:
+        out.attrs['chunk_size'] = chunk_size
+        names = [name for name in PANELS if name in f['data']]
+        num_frames = f['data'][names[0]].shape[0]
+        levels = {}
+        for factor in factors:
+            group = out.create_group(str(factor))
+            for name in names:
+                shape = f['data'][name].shape
+                small = (num_frames, shape[1] // factor, shape[2] // factor) + shape[3:]
+                levels[factor, name] = group.create_dataset(
+                    name, small, dtype=np.float16 if name == 'depth' else np.uint8,
+                    chunks=(min(chunk_size, num_frames),) + small[1:], compression='lzf')
+        for start, end in tqdm(list(iter_chunks(num_frames, chunk_size)), desc='Building previews'):
+            for name in names:
+                data = f['data'][name][start:end]
+                for factor in factors:
+                    levels[factor, name][start:end] = downsample(name, data, factor)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+class FramePrefetcher:
+    """
+    LRU cache of blocks of frames, aligned with the storage chunks. A background thread loads the blocks around the
+    last requested frame so that stepping and playback hit the cache.
+    """
+    def __init__(self, datasets, block_size, max_blocks=16, ahead=2):
+        self.datasets = datasets
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.ahead = ahead
+        self.num_frames = list(datasets.values())[0].shape[0]
+        self._blocks = OrderedDict()
+        self._lock = Lock()
+        self._requests = Queue()
+        self._thread = Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def _load(self, block):
+        start = block * self.block_size
+        return {name: d[start:start + self.block_size] for name, d in self.datasets.items()}
+
+    def _insert(self, block, data):
+        with self._lock:
+            self._blocks[block] = data
+            self._blocks.move_to_end(block)
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+
+    def _cached(self, block):
+        with self._lock:
+            data = self._blocks.get(block)
+            if data is not None:
+                self._blocks.move_to_end(block)
+            return data
+
+    def _prefetch(self):
+        while True:
+            block = self._requests.get()
+            if block is None:
+                return
+            if self._cached(block) is None:
+                self._insert(block, self._load(block))
+
+    def get(self, i):
+        block = i // self.block_size
+        data = self._cached(block)
+        if data is None:
+            data = self._load(block)
+            self._insert(block, data)
+        # drop stale requests, only the neighborhood of the current frame matters
+        try:
+            while True:
+                self._requests.get_nowait()
+        except Empty:
+            pass
+        num_blocks = (self.num_frames + self.block_size - 1) // self.block_size
+        for offset in [1, -1] + list(range(2, self.ahead + 1)):
+            if 0 <= block + offset < num_blocks:
+                self._requests.put(block + offset)
+        return {name: d[i - block * self.block_size] for name, d in data.items()}
+
+    def close(self):
+        self._requests.put(None)
+
+
+class ScrubViewer:
+    """
+    Scrubs through a recording with previews, full resolution frames are shown once the frame stays put.
+    Keys: left/right one frame, down/up ten frames, space play/pause
+    """
+    def __init__(self, file, preview_file, factor, depth_max=1.0, fps=30, full_res_delay=0.3):
+        from matplotlib.widgets import Slider
+
+        self.file = file
+        self.preview = h5py.File(preview_file, 'r')
+        level = self.preview[str(factor)]
+        self.names = [name for name in PANELS if name in level]
+        self.prefetcher = FramePrefetcher({name: level[name] for name in self.names},
+                                          int(self.preview.attrs['chunk_size']))
+        self.num_frames = self.prefetcher.num_frames
+        self.index = 0
+        self.playing = False
+
+        self.fig, axes = plt.subplots(2, 2)
+        self.images = {}
+        frame = self.prefetcher.get(0)
+        for ax, name in zip(axes.ravel(), self.names):
+            ax.set_title(name)
+            ax.axis('off')
+            # previews are stretched over the full resolution extent, so both fill the same axes
+            h, w = file['data'][name].shape[1:3]
+            extent = (-0.5, w - 0.5, h - 0.5, -0.5)
+            if name == 'depth':
+                self.images[name] = ax.imshow(frame[name].astype(np.float32), vmin=0, vmax=depth_max, extent=extent)
+            else:
+                self.images[name] = ax.imshow(frame[name], extent=extent)
+        for ax in axes.ravel()[len(self.names):]:
+            ax.axis('off')
+        slider_ax = self.fig.add_axes([0.15, 0.02, 0.7, 0.03])
+        self.slider = Slider(slider_ax, 'frame', 0, self.num_frames - 1, valinit=0, valstep=1)
+        self.slider.on_changed(self._on_slider)
+        self.fig.canvas.mpl_connect('key_press_event', self._on_key)
+
+        self.play_timer = self.fig.canvas.new_timer(interval=int(1000 / fps))
+        self.play_timer.add_callback(self._on_play)
+        self.full_res_timer = self.fig.canvas.new_timer(interval=int(full_res_delay * 1000))
+        self.full_res_timer.single_shot = True
+        self.full_res_timer.add_callback(self._show_full_res)
+
+    def _draw(self, frame):
+        for name in self.names:
+            data = frame[name]
+            self.images[name].set_data(data.astype(np.float32) if name == 'depth' else data)
+        self.fig.canvas.draw_idle()
+
+    def _show_full_res(self):
+        if self.playing:
+            return
+        self._draw({name: self.file['data'][name][self.index] for name in self.names})
+
+    def set_frame(self, i):
+        self.index = int(np.clip(i, 0, self.num_frames - 1))
+        self._draw(self.prefetcher.get(self.index))
+        self.full_res_timer.stop()
+        if not self.playing:
+            self.full_res_timer.start()
+
+    def _on_slider(self, value):
+        if int(value) != self.index:
+            self.set_frame(int(value))
+
+    def _step(self, step):
+        # moving the slider redraws through its callback
+        self.slider.set_val(int(np.clip(self.index + step, 0, self.num_frames - 1)))
+
+    def _on_key(self, event):
+        steps = {'right': 1, 'left': -1, 'up': 10, 'down': -10}
+        if event.key in steps:
+            self._step(steps[event.key])
+        elif event.key == ' ':
+            self.playing = not self.playing
+            if self.playing:
+                self.play_timer.start()
+            else:
+                self.play_timer.stop()
+                self.set_frame(self.index)
+
+    def _on_play(self):
+        if self.index >= self.num_frames - 1:
+            self.playing = False
+            self.play_timer.stop()
+            self.set_frame(self.index)
+            return
+        self._step(1)
+
+    def show(self):
+        self.set_frame(0)
+        plt.show()
+        self.prefetcher.close()
+        self.preview.close()
 
 
 def view_data():
     if args.idx is None:
-        for i in range(l_img.shape[0]):
-            plt.subplot(221)
-            plt.imshow(l_img[i])
-            plt.subplot(222)
-            plt.imshow(r_img[i])
-            plt.subplot(223)
-            plt.imshow(depth[i], vmax=1)
-            plt.subplot(224)
-            plt.imshow(segm[i])
-
-            plt.show()
+        preview_file = build_previews(args.file, args.preview_dir, args.preview_factors, args.preview_chunk_size)
+        ScrubViewer(file, preview_file, args.preview_factors[0], args.depth_max, args.fps).show()
     else:
         i = int(args.idx[0])
         j = int(args.idx[1])
@@ -51,18 +265,77 @@ def view_data():
         print(np.linalg.inv(np.linalg.inv(pose_cam[j]) @ pose_drill[j]) @ (np.linalg.inv(pose_cam[i]) @ pose_drill[i]))
 
 
+def depth_colormap_lut(name=None):
+    """
+    256 entry colormap, matplotlib maps floats in [0, 1] to the same 256 bins
+    """
+    cmap = plt.get_cmap(name)
+    return (cmap(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+
+def compose_frames(chunk, lut, panel_size, depth_max, columns=2):
+    """
+    tile the panels of a chunk of frames into video frames
+    :param chunk: dict of panel name -> NxHxWx3 (NxHxW for depth)
+    :param panel_size: (width, height) of each panel
+    :return: NxHxWx3 uint8
+    """
+    panels = []
+    for name, data in chunk.items():
+        if name == 'depth':
+            q = np.nan_to_num(data.astype(np.float32)) * (256.0 / depth_max)
+            data = lut[np.clip(q, 0, 255).astype(np.uint8)]
+        if data.shape[2] != panel_size[0] or data.shape[1] != panel_size[1]:
+            data = np.stack([cv2.resize(d, panel_size, interpolation=cv2.INTER_AREA) for d in data], axis=0)
+        panels.append(data)
+
+    # fill the last row of the grid with black panels
+    while len(panels) % columns != 0:
+        panels.append(np.zeros_like(panels[0]))
+    rows = [np.concatenate(panels[r:r + columns], axis=2) for r in range(0, len(panels), columns)]
+    return np.ascontiguousarray(np.concatenate(rows, axis=1))
+
+
 def generate_video():
-    cmap = plt.get_cmap()
-    out = cv2.VideoWriter('output.avi', cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), 30, (640 * 2, 480 * 2))
+    panels = args.panels
+    start = args.frames[0] if args.frames is not None else 0
+    end = args.frames[1] if args.frames is not None else l_img.shape[0]
+    end = min(end, l_img.shape[0])
+    datasets = dict(l_img=l_img, r_img=r_img, depth=depth, segm=segm)
+
+    if args.resolution is not None:
+        panel_size = (args.resolution[0], args.resolution[1])
+    else:
+        panel_size = (datasets[panels[0]].shape[2], datasets[panels[0]].shape[1])
+    columns = min(2, len(panels))
+    rows = (len(panels) + columns - 1) // columns
+    out = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), args.fps,
+                          (panel_size[0] * columns, panel_size[1] * rows))
+    lut = depth_colormap_lut()
 
-    for i in tqdm(range(l_img.shape[0])):
-        d = (cmap(depth[i])[..., :3] * 255).astype(np.uint8)
-        rgb = np.concatenate([l_img[i], r_img[i]], axis=1)
-        depth_segm = np.concatenate([d, segm[i]], axis=1)
-        frame = np.concatenate([rgb, depth_segm], axis=0)
-        out.write(frame)
+    # chunks are read in this process, composed by the workers and written back in order
+    pending = deque()
+    t_start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor, tqdm(total=end - start) as pbar:
+        for s in range(start, end, args.chunk_size):
+            e = min(s + args.chunk_size, end)
+            chunk = OrderedDict((name, datasets[name][s:e]) for name in panels)
+            pending.append(executor.submit(compose_frames, chunk, lut, panel_size, args.depth_max, columns))
+            while len(pending) > 2 * args.workers or (pending and pending[0].done()):
+                frames = pending.popleft().result()
+                for frame in frames:
+                    out.write(frame)
+                pbar.update(len(frames))
+        while pending:
+            frames = pending.popleft().result()
+            for frame in frames:
+                out.write(frame)
+            pbar.update(len(frames))
 
     out.release()
+    elapsed = time.time() - t_start
+    print("Exported %d frames in %.1f s: %.1f fps (%.2fx the recording rate of %d fps)" % (
+        end - start, elapsed, (end - start) / elapsed, (end - start) / elapsed / args.fps, args.fps))
 
 
 if __name__ == "__main__":
@@ -70,6 +343,19 @@ if __name__ == "__main__":
     parser.add_argument('--file', type=str, default=None, action='store', help='Iterate through all data frame by frame')
     parser.add_argument('--idx', nargs='+', default=None, action='store', help='View the data of provided index')
     parser.add_argument('--generate_video', action='store_true', help="create a video of recorded data")
+    parser.add_argument('--output', type=str, default='output.avi', help='Video file name')
+    parser.add_argument('--panels', nargs='+', default=['l_img', 'r_img', 'depth', 'segm'],
+                        choices=['l_img', 'r_img', 'depth', 'segm'], help='Panels of the video, tiled two per row')
+    parser.add_argument('--resolution', nargs=2, type=int, default=None, help='Width and height of each panel')
+    parser.add_argument('--frames', nargs=2, type=int, default=None, help='Start and end frame index')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--depth_max', type=float, default=1.0, help='Depth mapped to the end of the colormap')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes composing video frames')
+    parser.add_argument('--chunk_size', type=int, default=50, help='Frames read and composed at once')
+    parser.add_argument('--preview_factors', nargs='+', type=int, default=[4],
+                        help='Downsampling of the preview levels built once per recording, the first is viewed')
+    parser.add_argument('--preview_chunk_size', type=int, default=32, help='Frames per preview storage chunk')
+    parser.add_argument('--preview_dir', type=str, default='.preview_cache', help='Directory of cached previews')
     args = parser.parse_args()
 
     if args.file is not None:
@@ -79,11 +365,9 @@ if __name__ == "__main__":
         depth = file["data"]["depth"]
         segm = file["data"]["segm"]
         K = file['metadata']["camera_intrinsic"]
-        extrinsic = file['metadata']['camera_extrinsic']
-
-        pose_cam = pose_to_matrix(file['data']['pose_main_camera'])
-        pose_cam = np.matmul(pose_cam, np.linalg.inv(extrinsic)[None])  # update pose so world directly maps to CV
-        pose_drill = pose_to_matrix(file['data']['pose_mastoidectomy_drill'])
+        tree = TransformTree.from_recording(file)
+        pose_cam = tree.lookup('world', CV)  # world directly maps to CV
+        pose_drill = tree.lookup('world', 'mastoidectomy_drill')
 
         if args.generate_video:
             generate_video()
@@ -0,0 +1,70 @@
+import numpy as np
+
+SIDECAR_NAME = 'distance_fields.npz'
+
+
+def compute_distance_fields(masks, spacing_mm, step_mm=0.1):
+    """
+    Euclidean distance of every voxel to the nearest voxel of each mask, quantized to uint8 steps of step_mm. Voxels
+    inside a mask are 0 and distances beyond 255 steps saturate.
+    :param masks: list of XxYxZ bool arrays in NRRD order at export resolution
+    :param spacing_mm: voxel size along the three NRRD axes at export resolution
+    :return: XxYxZxS uint8 array in plugin voxel order (x = image column, y = image row, z = slice)
+    """
+    from scipy.ndimage import distance_transform_edt
+
+    shape = masks[0].shape
+    # slices are saved with the first NRRD axis as image rows, the plugin indexes voxels by column first
+    fields = np.full((shape[1], shape[0], shape[2], len(masks)), 255, dtype=np.uint8)
+    for i, mask in enumerate(masks):
+        if not mask.any():
+            print('WARN! Segment ', i, ' is empty at export resolution, its distance saturates')
+            continue
+        distance = distance_transform_edt(~mask, sampling=spacing_mm)
+        fields[..., i] = np.minimum(np.rint(distance / step_mm), 255).astype(np.uint8).transpose(1, 0, 2)
+    return fields
+
+
+class DistanceFields:
+    """
+    Quantized distance of every voxel of an exported volume to a set of segments, e.g. facial nerve and sigmoid sinus.
+    Fields are stored per voxel (XxYxZxS) so one gather returns the distances to all segments of a point.
+    """
+    def __init__(self, fields, names, step_mm, spacing_mm, build_key=''):
+        self.fields = fields
+        self.names = list(names)
+        self.step_mm = float(step_mm)
+        # voxel size along plugin voxel axes
+        self.spacing_mm = np.asarray(spacing_mm, dtype=np.float64)
+        self.build_key = build_key
+        self.max_mm = 255 * self.step_mm
+
+    @property
+    def shape(self):
+        return self.fields.shape[:3]
+
+    def save(self, filename):
+        np.savez_compressed(filename, fields=self.fields, names=np.array(self.names), step_mm=self.step_mm,
+                            spacing_mm=self.spacing_mm, build_key=self.build_key)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as data:
+            return DistanceFields(data['fields'], [str(n) for n in data['names']], data['step_mm'],
+                                  data['spacing_mm'], str(data['build_key']))
+
+    def segment_index(self, name):
+        lowered = [n.lower() for n in self.names]
+        return lowered.index(name.lower())
+
+    def lookup(self, voxels):
+        """
+        :param voxels: Nx3 voxel coordinates in plugin order, need not be integer or inside the volume
+        :return: NxS distances in mm. Points outside the volume get the distance of the nearest boundary voxel plus
+        their distance to it, saturated values read as max_mm
+        """
+        voxels = np.rint(np.atleast_2d(voxels)).astype(np.int64)
+        clipped = np.clip(voxels, 0, np.array(self.shape) - 1)
+        distance = self.fields[clipped[:, 0], clipped[:, 1], clipped[:, 2]].astype(np.float32) * self.step_mm
+        outside = np.linalg.norm((voxels - clipped) * self.spacing_mm, axis=-1)
+        return distance + outside[:, None].astype(np.float32)
@@ -0,0 +1,108 @@
+'''
+Stereo disparity ground truth of recordings. The depth of the segmentation camera is converted to disparity of the
+stereoL view, d = f * baseline / z, with the recorded intrinsic and metadata/baseline. Frames are converted in chunks
+in a single pass and results are written to <output>/<recording>_disparity.hdf5 aligned with data/time, the recordings
+themselves are left untouched.
+
+- disparity: NxHxW, uint16 fixed point (d * scale, 0 where invalid) or float16 (nan where invalid)
+- disparity_valid: NxHxW bool, finite positive depth with disparity within range
+
+python3 export_disparity.py --file ~/recordings/session_1 --output disparity
+'''
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from batch_validation import find_recordings
+from data_validation import iter_chunks
+from utils import *
+
+
+def depth_to_disparity(depth, focal, baseline, max_disparity):
+    """
+    :return: disparity in pixels and validity mask, both NxHxW
+    """
+    depth = depth.astype(np.float32)
+    valid = np.isfinite(depth) & (depth > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disparity = np.where(valid, np.float32(focal * baseline) / depth, 0)
+    valid &= disparity < max_disparity
+    return np.where(valid, disparity, 0), valid
+
+
+def disparity_path(filename, output_dir):
+    return Path(output_dir) / (Path(filename).stem + '_disparity.hdf5')
+
+
+def export_file(filename, output_dir, fmt='uint16', scale=64.0, chunk_size=100, baseline=None, overwrite=False):
+    out_file = disparity_path(filename, output_dir)
+    if out_file.exists() and not overwrite:
+        return None
+    # written to a temporary file and renamed once complete, an interrupted run never looks finished
+    tmp_file = out_file.with_name(out_file.name + '.tmp')
+    with h5py.File(filename, 'r') as f, h5py.File(tmp_file, 'w') as out:
+        result = export_datasets(f['data'], f['metadata'], out, fmt, scale, chunk_size, baseline)
+    os.replace(tmp_file, out_file)
+    return (out_file,) + result
+
+
+def export_datasets(data, metadata, out, fmt, scale, chunk_size, baseline):
+    if baseline is None:
+        baseline = float(metadata['baseline'][()])
+    focal = float(metadata['camera_intrinsic'][()][0, 0])
+    num_frames, h, w = data['depth'].shape
+    shape, chunks = (num_frames, h, w), (1, h, w)
+
+    out.create_dataset('time', data=data['time'][()])
+    if fmt == 'uint16':
+        # 0 is reserved for invalid pixels
+        max_disparity = (np.iinfo(np.uint16).max - 1) / scale
+        disparity = out.create_dataset('disparity', shape, dtype=np.uint16, chunks=chunks, compression='gzip')
+        disparity.attrs['scale'] = scale
+        disparity.attrs['units'] = 'pixels * scale, 0 where invalid'
+    else:
+        max_disparity = float(np.finfo(np.float16).max)
+        disparity = out.create_dataset('disparity', shape, dtype=np.float16, chunks=chunks, compression='gzip')
+        disparity.attrs['units'] = 'pixels, nan where invalid'
+    disparity.attrs['baseline'] = baseline
+    disparity.attrs['README'] = 'Disparity of the stereoL view, from the depth of the segmentation camera'
+    disparity_valid = out.create_dataset('disparity_valid', shape, dtype=bool, chunks=chunks, compression='gzip')
+
+    num_valid = 0
+    for start, end in iter_chunks(num_frames, chunk_size):
+        d, valid = depth_to_disparity(data['depth'][start:end], focal, baseline, max_disparity)
+        if fmt == 'uint16':
+            disparity[start:end] = np.where(valid, np.rint(d * scale).clip(1), 0).astype(np.uint16)
+        else:
+            disparity[start:end] = np.where(valid, d, np.nan).astype(np.float16)
+        disparity_valid[start:end] = valid
+        num_valid += np.count_nonzero(valid)
+    return num_frames, num_valid
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--file', type=str, nargs='+', required=True, help='hdf5 files or session directories')
+    parser.add_argument('--format', choices=['uint16', 'float16'], default='uint16')
+    parser.add_argument('--scale', type=float, default=64.0, help='Fixed point steps per pixel of uint16 disparity')
+    parser.add_argument('--baseline', type=float, default=None, help='Override metadata/baseline, meters')
+    parser.add_argument('--output', type=str, default='disparity', help='Output directory')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Frames converted at once')
+    parser.add_argument('--overwrite', action='store_true', help='Replace disparity already exported')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    for filename in find_recordings(args.file):
+        result = export_file(filename, args.output, args.format, args.scale, args.chunk_size, args.baseline,
+                             args.overwrite)
+        if result is None:
+            print(WARN_STR(str(disparity_path(filename, args.output))), 'exists, use --overwrite to replace it')
+        else:
+            print(OK_STR(str(result[0])), 'frames: %d valid pixels: %d' % result[1:])
+
+
+if __name__ == '__main__':
+    main()
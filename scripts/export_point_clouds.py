@@ -0,0 +1,129 @@
+'''
+Back-projects recorded depth into point clouds, chunk by chunk, so whole sessions export without loading all depth
+frames. Points are expressed in the world, volume (pose_mastoidectomy_volume) or camera frame and colored by the
+segmentation image.
+
+The following is an example writing one voxel filtered cloud of a session in the volume frame:
+python3 export_point_clouds.py --file ~/recordings/session_1 --frame volume --voxel_size 0.0005 --merge
+'''
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from batch_validation import find_recordings
+from data_validation import iter_chunks
+from projection import backproject, transform_points, voxel_filter, write_ply
+from transform_tree import CV, WORLD, TransformTree
+from utils import *
+
+
+class CloudMerger:
+    """
+    voxel filtered union of clouds, the running voxel sums stay bounded by the number of occupied voxels
+    """
+    def __init__(self, voxel_size):
+        self.voxel_size = voxel_size
+        self.keys = np.zeros((0, 3), dtype=np.int64)
+        self.sums = np.zeros((0, 6))
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, points, colors):
+        keys = np.concatenate([self.keys, np.floor(points / self.voxel_size).astype(np.int64)])
+        sums = np.concatenate([self.sums, np.concatenate([points, colors], axis=-1)])
+        counts = np.concatenate([self.counts, np.ones(len(points), dtype=np.int64)])
+        self.keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.sums = np.zeros((len(self.keys), 6))
+        np.add.at(self.sums, inverse, sums)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+
+    def result(self):
+        mean = self.sums / np.maximum(self.counts, 1)[:, None]
+        return mean[:, :3].astype(np.float32), mean[:, 3:].astype(np.uint8)
+
+
+def save_cloud(filename, points, colors, fmt):
+    if fmt == 'ply':
+        write_ply(str(filename) + '.ply', points, colors)
+    else:
+        np.savez_compressed(str(filename) + '.npz', points=points, colors=colors)
+
+
+def export_file(filename, args, merger=None):
+    f = h5py.File(filename, 'r')
+    intrinsic = f['metadata']['camera_intrinsic'][()]
+    num_frames = f['data']['time'].shape[0]
+    has_segm = 'segm' in f['data']
+    stem = Path(filename).stem
+    num_points = 0
+
+    for start, end in iter_chunks(num_frames, args.chunk_size):
+        frames = np.arange(start, end)
+        frames = frames[frames % args.every == 0]
+        if len(frames) == 0:
+            continue
+        depth = f['data']['depth'][frames[0]:frames[-1] + 1:args.every]
+        points = backproject(depth, intrinsic, args.stride).reshape(len(frames), -1, 3)
+        if has_segm:
+            # BGR as recorded by cv_bridge
+            colors = f['data']['segm'][frames[0]:frames[-1] + 1:args.every][:, ::args.stride, ::args.stride, ::-1]
+            colors = colors.reshape(len(frames), -1, 3)
+        else:
+            colors = np.full(points.shape, 255, dtype=np.uint8)
+
+        if args.frame != 'camera':
+            tree = TransformTree.from_recording(f, frames[0], frames[-1] + 1)
+            target = WORLD if args.frame == 'world' else 'mastoidectomy_volume'
+            tau = tree.lookup(target, CV)[::args.every]
+            points = transform_points(tau, points)
+
+        z = depth[:, ::args.stride, ::args.stride].reshape(len(frames), -1)
+        valid = np.isfinite(z) & (z > 0)
+        if args.max_depth is not None:
+            valid &= z < args.max_depth
+        for i, frame in enumerate(frames):
+            p, c = points[i][valid[i]], colors[i][valid[i]]
+            if merger is not None:
+                merger.add(p, c)
+                continue
+            if args.voxel_size is not None:
+                p, c = voxel_filter(p, args.voxel_size, c)
+            save_cloud(Path(args.output) / (stem + '_' + str(frame).zfill(6)), p, c, args.format)
+            num_points += len(p)
+    f.close()
+    return num_frames, num_points
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--file', type=str, nargs='+', required=True, help='hdf5 files or session directories')
+    parser.add_argument('--output', type=str, default='point_clouds', help='Output directory')
+    parser.add_argument('--frame', choices=['world', 'volume', 'camera'], default='world')
+    parser.add_argument('--format', choices=['ply', 'npz'], default='ply')
+    parser.add_argument('--stride', type=int, default=2, help='Pixel stride of back-projected depth')
+    parser.add_argument('--every', type=int, default=1, help='Export every n-th frame')
+    parser.add_argument('--voxel_size', type=float, default=None, help='Voxel filter size in meters')
+    parser.add_argument('--max_depth', type=float, default=None, help='Drop points farther from the camera, meters')
+    parser.add_argument('--merge', action='store_true', help='Write one voxel filtered cloud of all frames')
+    parser.add_argument('--chunk_size', type=int, default=50, help='Frames loaded at once')
+    args = parser.parse_args()
+
+    if args.merge and args.voxel_size is None:
+        parser.error('--merge requires --voxel_size')
+    os.makedirs(args.output, exist_ok=True)
+    merger = CloudMerger(args.voxel_size) if args.merge else None
+
+    for filename in find_recordings(args.file):
+        num_frames, num_points = export_file(filename, args, merger)
+        print(INFO_STR(str(filename)), 'frames: %d points written: %d' % (num_frames, num_points))
+    if merger is not None:
+        points, colors = merger.result()
+        save_cloud(Path(args.output) / 'merged', points, colors, args.format)
+        print(OK_STR('Merged cloud of %d points' % len(points)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''
+Dense optical flow and scene flow ground truth of every consecutive frame pair of a recording. Pixels of the drill
+(by segmentation color) move with the drill pose, all other pixels are static anatomy and only move with the camera.
+Frames are read in chunks and results are written to <output>/<recording>_flow.hdf5 aligned with data/time.
+
+- optical_flow: NxHxWx2 (du, dv) from frame i to i + 1 in pixels
+- scene_flow: NxHxWx3 camera coordinates of a point in frame i + 1 minus those in frame i, in meters
+- flow_mask: NxHxW bits, VALID (flow defined), VISIBLE (not occluded in frame i + 1), DRILL (moves with the drill)
+The last frame has no successor and is left invalid.
+
+python3 flow_ground_truth.py --file ~/recordings/session_1 --output flow
+'''
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from batch_validation import find_recordings
+from data_validation import iter_chunks
+from projection import backproject, transform_points
+from segm_classes import DEFAULT_PALETTE, SegmClassifier
+from transform_tree import CV, WORLD, TransformTree
+from utils import *
+
+VALID = 1
+VISIBLE = 2
+DRILL = 4
+
+SEGM_CLASSES = SegmClassifier(DEFAULT_PALETTE)
+
+
+def frame_pair_flow(K, depth, segm, static, moving, occlusion_tol=0.01):
+    """
+    flow between consecutive frames of a chunk
+    :param depth: NxHxW, segm: NxHxWx3
+    :param static, moving: (N-1)x4x4 T_ci+1_ci of static anatomy and of points moving with the drill
+    :return: optical flow (N-1)xHxWx2, scene flow (N-1)xHxWx3, mask (N-1)xHxW uint8
+    """
+    n, h, w = depth.shape
+    X0 = backproject(depth[:-1], K).reshape(n - 1, -1, 3)  # points in camera i
+    drill = (SEGM_CLASSES.labels(segm[:-1]) == SEGM_CLASSES.class_id('drill')).reshape(n - 1, -1)
+    X1 = np.where(drill[..., None], transform_points(moving, X0), transform_points(static, X0))
+
+    uvz = X1 @ K.T.astype(np.float32)
+    z1 = uvz[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv1 = uvz[..., :2] / z1[..., None]
+    v0, u0 = np.mgrid[0:h, 0:w]
+    uv0 = np.stack([u0, v0], axis=-1).reshape(1, -1, 2).astype(np.float32)
+
+    z0 = depth[:-1].reshape(n - 1, -1)
+    valid = np.isfinite(z0) & (z0 > 0) & (z1 > 0)
+    # visible when the point lands inside frame i + 1 in front of what the depth there shows
+    u1 = np.rint(np.where(valid, uv1[..., 0], -1)).astype(np.int64)
+    v1 = np.rint(np.where(valid, uv1[..., 1], -1)).astype(np.int64)
+    inside = valid & (0 <= u1) & (u1 < w) & (0 <= v1) & (v1 < h)
+    p, m = np.nonzero(inside)
+    z_next = depth[1:][p, v1[p, m], u1[p, m]]
+    visible = np.zeros_like(inside)
+    visible[p, m] = z1[p, m] <= z_next * (1 + occlusion_tol)
+
+    mask = valid * VALID + visible * VISIBLE + drill * DRILL
+    optical_flow = np.where(valid[..., None], uv1 - uv0, 0)
+    scene_flow = np.where(valid[..., None], X1 - X0, 0)
+    return optical_flow.reshape(n - 1, h, w, 2), scene_flow.reshape(n - 1, h, w, 3), \
+        mask.astype(np.uint8).reshape(n - 1, h, w)
+
+
+def export_file(filename, output_dir, chunk_size=20, occlusion_tol=0.01):
+    f = h5py.File(filename, 'r')
+    intrinsic = f['metadata']['camera_intrinsic'][()].astype(np.float32)
+    num_frames, h, w = f['data']['depth'].shape
+
+    out_file = Path(output_dir) / (Path(filename).stem + '_flow.hdf5')
+    out = h5py.File(out_file, 'w')
+    out.create_dataset('time', data=f['data']['time'][()])
+    frame_chunks = (1, h, w)
+    optical_flow = out.create_dataset('optical_flow', (num_frames, h, w, 2), dtype=np.float16,
+                                      chunks=frame_chunks + (2,), compression='gzip')
+    scene_flow = out.create_dataset('scene_flow', (num_frames, h, w, 3), dtype=np.float16,
+                                    chunks=frame_chunks + (3,), compression='gzip')
+    flow_mask = out.create_dataset('flow_mask', (num_frames, h, w), dtype=np.uint8, chunks=frame_chunks,
+                                   compression='gzip')
+    flow_mask.attrs['bits'] = 'VALID=%d VISIBLE=%d DRILL=%d' % (VALID, VISIBLE, DRILL)
+
+    num_valid = 0
+    # consecutive chunks overlap by one frame so that every frame pair is computed once
+    for start, end in iter_chunks(max(num_frames - 1, 0), chunk_size):
+        end = end + 1
+        tree = TransformTree.from_recording(f, start, end)
+        flow, sflow, mask = frame_pair_flow(intrinsic, f['data']['depth'][start:end].astype(np.float32),
+                                            f['data']['segm'][start:end], tree.relative(CV, WORLD),
+                                            tree.relative(CV, 'mastoidectomy_drill'), occlusion_tol)
+        optical_flow[start:end - 1] = flow
+        scene_flow[start:end - 1] = sflow
+        flow_mask[start:end - 1] = mask
+        num_valid += np.count_nonzero(mask & VALID)
+    f.close()
+    out.close()
+    return out_file, num_frames, num_valid
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--file', type=str, nargs='+', required=True, help='hdf5 files or session directories')
+    parser.add_argument('--output', type=str, default='flow', help='Output directory')
+    parser.add_argument('--chunk_size', type=int, default=20, help='Frames loaded at once')
+    parser.add_argument('--occlusion_tol', type=float, default=0.01,
+                        help='Relative depth tolerance before a reprojected point counts as occluded')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    for filename in find_recordings(args.file):
+        out_file, num_frames, num_valid = export_file(filename, args.output, args.chunk_size, args.occlusion_tol)
+        print(OK_STR(str(out_file)), 'frames: %d valid flow pixels: %d' % (num_frames, num_valid))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+'''
+Builds a compact per-frame table of each recording so that frames can be selected without decoding images. The table
+holds the pixel count of every segmentation class, drill and camera poses, the burr size and drill force at the time
+of the frame and the number of voxels removed since the previous frame. It is written to <recording>_index.npz next to
+the recording, the recording itself is only read.
+
+Pixels are counted for the drill and mastoid colors, or with --segments for the drill and every segment of a
+segmentation NRRD (or of the nrrd_header.pkl batch_volumes.py writes next to a PNG stack).
+
+Queries are expressions over the columns with comparisons, arithmetic, and/or/not (or &, |, ~) and components of pose
+columns (pose_mastoidectomy_drill[2]), visible_<class> is count_<class> > 0:
+python3 frame_index.py --file ~/recordings/session_1 --segments ~/volumes/ear3.seg.nrrd
+python3 frame_index.py --file ~/recordings/session_1 --query "visible_drill & (force > 2)"
+'''
+import ast
+import pickle
+import re
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import nrrd
+import numpy as np
+
+from batch_validation import find_recordings
+from data_validation import iter_chunks
+from seg_nrrd_to_pngs import NrrdConverter
+from segm_classes import DEFAULT_PALETTE, DRILL_COLOR, SegmClassifier, palette_from_segments
+from utils import *
+
+
+def column_name(name):
+    return re.sub(r'[^0-9A-Za-z_]+', '_', name.strip()).lower()
+
+
+def value_at(time_stamps, values, frame_times):
+    """
+    latest value at or before each frame, the first value before any was recorded, nan without values
+    """
+    if len(time_stamps) == 0:
+        return np.full(len(frame_times), np.nan)
+    idx = np.clip(np.searchsorted(time_stamps, frame_times, side='right') - 1, 0, len(time_stamps) - 1)
+    return np.asarray(values)[idx]
+
+
+def removed_since_previous(f, frame_times):
+    if 'voxel_time_stamp' not in f.get('voxels_removed', {}):
+        return np.zeros(len(frame_times), dtype=np.uint32)
+    time_stamps = f['voxels_removed']['voxel_time_stamp'][()]
+    # the index column counts all messages, time stamps exist only for messages that removed voxels
+    _, counts = np.unique(f['voxels_removed']['voxel_removed'][:, 0], return_counts=True)
+    removed = np.concatenate([[0], np.cumsum(counts)])[np.searchsorted(time_stamps, frame_times, side='right')]
+    return np.diff(removed, prepend=0).astype(np.uint32)
+
+
+def segments_palette(filename):
+    """
+    drill and the segment colors of a segmentation NRRD or of its pickled header
+    """
+    if str(filename).endswith('.pkl'):
+        with open(filename, 'rb') as fp:
+            header = pickle.load(fp)
+    else:
+        header = nrrd.read_header(str(filename))
+    converter = NrrdConverter(1, 1, 1)
+    converter.nrrd_hdr = header
+    converter.initialize_segments_infos()
+    segments = [seg_info for seg_info in converter.select_segments([]) if seg_info.color is not None]
+    if len(segments) == 0:
+        raise ValueError('No segments in ' + str(filename))
+    palette = {'drill': DRILL_COLOR}
+    palette.update(palette_from_segments(segments))
+    return palette
+
+
+def build_index(f, palette=DEFAULT_PALETTE, chunk_size=100):
+    data = f['data']
+    frame_times = data['time'][()]
+    num_frames = len(frame_times)
+    columns = dict(time=frame_times)
+
+    if 'segm' in data:
+        classifier = SegmClassifier(palette)
+        counts = np.zeros((num_frames, classifier.num_classes), dtype=np.uint32)
+        for start, end in iter_chunks(num_frames, chunk_size):
+            counts[start:end] = classifier.counts(classifier.labels(data['segm'][start:end]))
+        for i, name in enumerate(['other'] + classifier.names):
+            columns['count_' + column_name(name)] = counts[:, i]
+
+    for key in data.keys():
+        if key.startswith('pose_'):
+            columns[key] = data[key][()].astype(np.float32)
+
+    if 'burr_size' in f.get('burr_change', {}):
+        columns['burr_size'] = value_at(f['burr_change']['time_stamp'][()], f['burr_change']['burr_size'][()],
+                                        frame_times).astype(np.float32)
+    if 'wrench' in f.get('drill_force_feedback', {}):
+        wrench = f['drill_force_feedback']['wrench'][()]
+        time_stamps = f['drill_force_feedback']['time_stamp'][()]
+        columns['force'] = value_at(time_stamps, np.linalg.norm(wrench[:, :3], axis=1), frame_times).astype(np.float32)
+        columns['torque'] = value_at(time_stamps, np.linalg.norm(wrench[:, 3:], axis=1), frame_times).astype(np.float32)
+    columns['voxels_removed'] = removed_since_previous(f, frame_times)
+    return columns
+
+
+def sidecar_file(filename):
+    return Path(filename).with_name(Path(filename).stem + '_index.npz')
+
+
+def write_index(filename, palette=DEFAULT_PALETTE, chunk_size=100):
+    with h5py.File(filename, 'r') as f:
+        columns = build_index(f, palette, chunk_size)
+    np.savez_compressed(sidecar_file(filename), **columns)
+    return columns
+
+
+def load_index(filename):
+    """
+    columns of a recording's frame index, None if it is not indexed
+    """
+    if not sidecar_file(filename).exists():
+        return None
+    with np.load(sidecar_file(filename)) as data:
+        return {key: data[key] for key in data.files}
+
+
+QUERY_OPERATORS = {
+    ast.And: np.logical_and, ast.Or: np.logical_or, ast.Not: np.logical_not, ast.Invert: np.logical_not,
+    ast.BitAnd: np.logical_and, ast.BitOr: np.logical_or, ast.BitXor: np.logical_xor, ast.USub: np.negative,
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide,
+    ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+
+def evaluate_query(node, namespace):
+    """
+    evaluates a parsed query, only columns, numbers, comparisons, arithmetic, and/or/not and indexing a component of a
+    column (pose_main_camera[2]) are allowed
+    """
+    if isinstance(node, ast.Expression):
+        return evaluate_query(node.body, namespace)
+    if isinstance(node, ast.Name):
+        if node.id not in namespace:
+            raise ValueError('Unknown column ' + node.id)
+        return namespace[node.id]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+        return node.value
+    if isinstance(node, ast.BoolOp) and type(node.op) in QUERY_OPERATORS:
+        values = [evaluate_query(v, namespace) for v in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = QUERY_OPERATORS[type(node.op)](result, value)
+        return result
+    if isinstance(node, (ast.BinOp, ast.UnaryOp)) and type(node.op) in QUERY_OPERATORS:
+        operands = [node.left, node.right] if isinstance(node, ast.BinOp) else [node.operand]
+        return QUERY_OPERATORS[type(node.op)](*[evaluate_query(v, namespace) for v in operands])
+    if isinstance(node, ast.Compare) and all(type(op) in QUERY_OPERATORS for op in node.ops):
+        left = evaluate_query(node.left, namespace)
+        result = True
+        for op, comparator in zip(node.ops, node.comparators):
+            right = evaluate_query(comparator, namespace)
+            result = np.logical_and(result, QUERY_OPERATORS[type(op)](left, right))
+            left = right
+        return result
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and \
+            isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, int):
+        column = evaluate_query(node.value, namespace)
+        if column.ndim != 2:
+            raise ValueError(node.value.id + ' has a single component')
+        return column[:, node.slice.value]
+    raise ValueError('Unsupported query syntax: ' + ast.dump(node))
+
+
+def query_frames(columns, expression):
+    """
+    :return: indices of the frames for which the expression over the index columns holds
+    """
+    namespace = dict(columns)
+    for key, value in columns.items():
+        if key.startswith('count_'):
+            namespace['visible_' + key[len('count_'):]] = value > 0
+    result = evaluate_query(ast.parse(expression, mode='eval'), namespace)
+    return np.flatnonzero(np.broadcast_to(result, columns['time'].shape))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--file', type=str, nargs='+', required=True, help='hdf5 files or session directories')
+    parser.add_argument('--query', type=str, default=None, help='Select frames of indexed recordings instead')
+    parser.add_argument('--segments', type=str, default=None,
+                        help='Segmentation NRRD or nrrd_header.pkl whose segment colors are counted')
+    parser.add_argument('--chunk_size', type=int, default=100, help='Segmentation frames classified at once')
+    args = parser.parse_args()
+
+    palette = DEFAULT_PALETTE if args.segments is None else segments_palette(args.segments)
+
+    for filename in find_recordings(args.file):
+        if args.query is None:
+            columns = write_index(filename, palette, args.chunk_size)
+            print(OK_STR(str(filename)), 'frames: %d columns: %s' % (len(columns['time']), ', '.join(columns)))
+            continue
+        columns = load_index(filename)
+        if columns is None:
+            print(WARN_STR(str(filename)), 'not indexed yet')
+            continue
+        try:
+            frames = query_frames(columns, args.query)
+        except (SyntaxError, ValueError) as e:
+            print(FAIL_STR('Invalid query'), e)
+            return
+        print(INFO_STR(str(filename)), '%d frames:' % len(frames), frames.tolist())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+'''
+Drill kinematics and motion economy metrics of recorded sessions: drill-tip path length, speed, jerk, idle time and
+dwell near segmented structures. Poses are streamed chunk by chunk, so a session of many recordings is processed in one
+pass without loading it. The tip is either derived from the frame-rate pose_mastoidectomy_drill stream or taken from
+the high-rate proximity stream data_record writes with --distance_fields, which also provides the distances for dwell.
+
+Results are cached per session (a directory of recordings, or a single recording) in --cache_dir:
+python3 kinematics.py --file ~/recordings/session_1 ~/recordings/session_2 --smoothing moving_average --window 5
+'''
+import hashlib
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+from scipy.signal import lfilter, lfilter_zi
+
+from batch_validation import file_key, find_recordings, load_cached, save_cached
+from data_validation import iter_chunks
+from transform_tree import pose_to_matrix
+from utils import *
+
+
+def smoothing_filter(method, window=5, alpha=0.3):
+    """
+    causal smoothing filter (b, a) applied to the tip positions, causal so that it can be streamed, None for raw poses
+    """
+    if method == 'none':
+        return None
+    if method == 'moving_average':
+        return np.ones(window) / window, np.array([1.0])
+    if method == 'ema':
+        return np.array([alpha]), np.array([1.0, alpha - 1.0])
+    raise ValueError('Unknown smoothing ' + method)
+
+
+def read_tip_stream(files, source, tip_offset, chunk_size):
+    """
+    :return: generator of (time Nx1, tip Nx3 in meters, distance NxS in mm or None) chunks in time order
+    """
+    for filename in files:
+        with h5py.File(filename, 'r') as f:
+            if source == 'proximity':
+                if 'time_stamp' not in f.get('proximity', {}):
+                    continue
+                group = f['proximity']
+                for start, end in iter_chunks(group['time_stamp'].shape[0], chunk_size):
+                    yield group['time_stamp'][start:end], group['tip_position'][start:end], \
+                        group['distance'][start:end]
+                continue
+            data = f['data']
+            for start, end in iter_chunks(data['time'].shape[0], chunk_size):
+                tau = pose_to_matrix(data['pose_mastoidectomy_drill'][start:end])
+                tip = tau[:, :3, -1] + tau[:, :3, :3] @ tip_offset
+                yield data['time'][start:end], tip, None
+
+
+def segment_names(files):
+    for filename in files:
+        with h5py.File(filename, 'r') as f:
+            if 'proximity' in f and 'segments' in f['proximity'].attrs:
+                return [n.decode() if isinstance(n, bytes) else str(n) for n in f['proximity'].attrs['segments']]
+    return []
+
+
+class KinematicsAccumulator:
+    """
+    Running sums of the metrics, chunks are fed in time order. The smoothing filter state and the last samples carry
+    over between chunks so that the result does not depend on the chunk size.
+    """
+    def __init__(self, smoothing=None, idle_speed=0.001, dwell_distance=1.0, num_segments=0):
+        self.smoothing = smoothing
+        self.zi = None
+        self.idle_speed = idle_speed
+        self.dwell_distance = dwell_distance
+        # last smoothed sample, velocity and acceleration (with their time stamps) of the previous chunk
+        self.last_t, self.last_p, self.last_d = None, None, None
+        self.last_v = self.last_a = None
+        self.last_tv = self.last_ta = None
+
+        self.first_t = None
+        self.num_samples = 0
+        self.path_length = 0.0
+        self.max_speed = 0.0
+        self.idle_time = 0.0
+        self.squared_jerk = 0.0  # integral of |jerk|^2 dt
+        self.jerk_time = 0.0
+        self.dwell = np.zeros(num_segments)
+
+    def add(self, t, p, distance=None):
+        t = np.asarray(t, dtype=np.float64).reshape(-1)
+        p = np.asarray(p, dtype=np.float64)
+        if len(t) == 0:
+            return
+        if self.first_t is None:
+            self.first_t = t[0]
+            if self.smoothing is not None:
+                # start at rest on the first sample instead of ramping up from the origin
+                self.zi = lfilter_zi(*self.smoothing)[:, None] * p[0][None]
+        if self.smoothing is not None:
+            p, self.zi = lfilter(*self.smoothing, p, axis=0, zi=self.zi)
+        self.num_samples += len(t)
+
+        if self.last_t is not None:
+            t = np.concatenate([[self.last_t], t])
+            p = np.concatenate([self.last_p[None], p])
+            if distance is not None:
+                distance = np.concatenate([self.last_d[None], distance])
+        # repeated (or out of order) time stamps carry no motion information
+        keep = np.concatenate([[True], t[1:] > np.maximum.accumulate(t)[:-1]])
+        t, p = t[keep], p[keep]
+        if distance is not None:
+            distance = distance[keep]
+
+        dt = np.diff(t)
+        step = np.linalg.norm(np.diff(p, axis=0), axis=1)
+        speed = step / dt
+        self.path_length += step.sum()
+        if len(speed):
+            self.max_speed = max(self.max_speed, speed.max())
+        self.idle_time += dt[speed < self.idle_speed].sum()
+        if distance is not None:
+            # a sample counts as dwelling for the interval up to the next one
+            self.dwell += ((distance[:-1] < self.dwell_distance) * dt[:, None]).sum(axis=0)
+
+        # finite differences at interval midpoints, non-uniform sampling
+        tv = (t[1:] + t[:-1]) / 2
+        v = np.diff(p, axis=0) / dt[:, None]
+        if self.last_v is not None:
+            tv, v = np.concatenate([[self.last_tv], tv]), np.concatenate([self.last_v[None], v])
+        ta = (tv[1:] + tv[:-1]) / 2
+        acc = np.diff(v, axis=0) / np.diff(tv)[:, None]
+        if self.last_a is not None:
+            ta, acc = np.concatenate([[self.last_ta], ta]), np.concatenate([self.last_a[None], acc])
+        jerk = np.diff(acc, axis=0) / np.diff(ta)[:, None]
+        self.squared_jerk += (np.sum(jerk ** 2, axis=1) * np.diff(ta)).sum()
+        self.jerk_time += np.diff(ta).sum()
+
+        self.last_t, self.last_p = t[-1], p[-1]
+        if distance is not None:
+            self.last_d = distance[-1]
+        if len(v):
+            self.last_tv, self.last_v = tv[-1], v[-1]
+        if len(acc):
+            self.last_ta, self.last_a = ta[-1], acc[-1]
+
+    def result(self, segments=()):
+        duration = 0.0 if self.first_t is None else float(self.last_t - self.first_t)
+        metrics = dict(num_samples=self.num_samples, duration=duration, path_length=float(self.path_length),
+                       mean_speed=float(self.path_length / duration) if duration > 0 else 0.0,
+                       max_speed=float(self.max_speed), idle_time=float(self.idle_time),
+                       rms_jerk=float(np.sqrt(self.squared_jerk / self.jerk_time)) if self.jerk_time > 0 else 0.0)
+        # dimensionless jerk, independent of the duration and length of the movement, lower is smoother
+        if self.path_length > 0:
+            metrics['dimensionless_jerk'] = float(np.sqrt(0.5 * self.squared_jerk * duration ** 5) / self.path_length)
+        for name, dwell in zip(segments, self.dwell):
+            metrics['dwell_' + name] = float(dwell)
+        return metrics
+
+
+def session_groups(paths):
+    """
+    a directory is one session of chunked recordings, a file on its own is a session
+    """
+    for p in paths:
+        p = Path(p)
+        files = find_recordings([p])
+        if len(files):
+            yield p.resolve(), files
+
+
+def session_key(files, setting):
+    sha = hashlib.sha1()
+    for filename in files:
+        sha.update(file_key(filename, setting).encode())
+    return sha.hexdigest()
+
+
+def session_metrics(files, args):
+    smoothing = smoothing_filter(args.smoothing, args.window, args.alpha)
+    segments = segment_names(files) if args.source == 'proximity' else []
+    accumulator = KinematicsAccumulator(smoothing, args.idle_speed, args.dwell_distance, len(segments))
+    for t, tip, distance in read_tip_stream(files, args.source, np.asarray(args.tip_offset), args.chunk_size):
+        accumulator.add(t, tip, distance)
+    return accumulator.result(segments)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--file', type=str, nargs='+', required=True, help='hdf5 files or session directories')
+    parser.add_argument('--source', choices=['frames', 'proximity'], default='frames',
+                        help='Frame-rate drill poses or the high-rate proximity stream')
+    parser.add_argument('--tip_offset', type=float, nargs=3, default=[0.0, 0.0, 0.0],
+                        help='Drill tip in the drill frame, meters (frames source only)')
+    parser.add_argument('--smoothing', choices=['none', 'moving_average', 'ema'], default='none')
+    parser.add_argument('--window', type=int, default=5, help='Samples of the moving average')
+    parser.add_argument('--alpha', type=float, default=0.3, help='Weight of the newest sample of the ema')
+    parser.add_argument('--idle_speed', type=float, default=0.001, help='Tip speed below which it is idle, m/s')
+    parser.add_argument('--dwell_distance', type=float, default=1.0, help='Distance to a segment counted as dwell, mm')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Pose samples loaded at once')
+    parser.add_argument('--cache_dir', type=str, default='.kinematics_cache', help='Directory of cached results')
+    parser.add_argument('--no_cache', action='store_true', help='Recompute every session')
+    parser.add_argument('--report', type=str, default=None, help='Write the metrics of all sessions to this json')
+    args = parser.parse_args()
+
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    setting = '%s|%s|%s|%d|%f|%f|%f' % (args.source, args.tip_offset, args.smoothing, args.window, args.alpha,
+                                        args.idle_speed, args.dwell_distance)
+    report = {}
+    for session, files in session_groups(args.file):
+        key = session_key(files, setting)
+        metrics = None if args.no_cache else load_cached(cache_dir, key)
+        if metrics is None:
+            metrics = session_metrics(files, args)
+            save_cached(cache_dir, key, metrics)
+        report[str(session)] = metrics
+        print(INFO_STR(str(session)), ' '.join('%s: %.4g' % (k, v) for k, v in metrics.items()))
+
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import re
+from pathlib import Path
+
+import numpy as np
+
+
+def marching_cubes(mask, dimensions):
+    """
+    surface of a XxYxZ bool mask in plugin voxel order, placed like the volume: centered on its pose and spanning
+    dimensions (ADF units) along each axis
+    :return: Vx3 vertices, Fx3 faces
+    """
+    from skimage.measure import marching_cubes as skimage_marching_cubes
+
+    # pad so that segments touching the border give closed surfaces
+    padded = np.pad(mask, 1).astype(np.uint8)
+    vertices, faces, _, _ = skimage_marching_cubes(padded, level=0.5)
+    count = np.array(mask.shape, dtype=np.float64)
+    vertices = ((vertices - 1 + 0.5) / count - 0.5) * np.asarray(dimensions, dtype=np.float64)
+    return vertices, faces
+
+
+def cluster_vertices(vertices, faces, cell_size):
+    """
+    merge all vertices within a grid cell into their mean and drop collapsed and duplicate faces
+    """
+    cells = np.floor(vertices / cell_size).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    merged = np.zeros((len(counts), 3))
+    np.add.at(merged, inverse, vertices)
+    merged /= counts[:, None]
+
+    faces = inverse[faces]
+    valid = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    faces = faces[valid]
+    # faces may collapse onto the same triangle, keep one (with its winding)
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(first)]
+
+    used, faces = np.unique(faces, return_inverse=True)
+    return merged[used], faces.reshape(-1, 3)
+
+
+def decimate(vertices, faces, max_faces, growth=1.2):
+    """
+    vertex clustering with a growing cell size until the mesh fits the triangle budget
+    """
+    if len(faces) <= max_faces:
+        return vertices, faces
+    # a surface of area A on a grid of cell size c has about 2 A / c^2 triangles
+    triangles = vertices[faces]
+    area = 0.5 * np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]),
+                                axis=1).sum()
+    cell_size = np.sqrt(2.0 * area / max_faces)
+    while True:
+        decimated_vertices, decimated_faces = cluster_vertices(vertices, faces, cell_size)
+        if len(decimated_faces) <= max_faces:
+            return decimated_vertices, decimated_faces
+        cell_size *= growth
+
+
+def mesh_name(name):
+    # segment names such as 'Facial Nerve' become file names such as 'Facial_Nerve'
+    return re.sub(r'[^0-9A-Za-z_\-]+', '_', name.strip())
+
+
+def write_mtl(filename, material, rgba):
+    with open(filename, 'w') as f:
+        f.write('# Material Count: 1\n\n')
+        f.write('newmtl ' + material + '\n')
+        f.write('Ns 323.999994\n')
+        f.write('Ka 1.000000 1.000000 1.000000\n')
+        f.write('Kd %.6f %.6f %.6f\n' % tuple(rgba[:3]))
+        f.write('Ks 0.500000 0.500000 0.500000\n')
+        f.write('Ke 0.000000 0.000000 0.000000\n')
+        f.write('Ni 1.450000\n')
+        f.write('d %.6f\n' % rgba[3])
+        f.write('illum 2\n')
+
+
+def write_obj(filename, name, vertices, faces):
+    filename = Path(filename)
+    with open(filename, 'w') as f:
+        f.write('mtllib ' + filename.stem + '.mtl\n')
+        f.write('o ' + name + '\n')
+        np.savetxt(f, vertices, fmt='v %.6f %.6f %.6f')
+        f.write('usemtl ' + name + '\n')
+        f.write('s off\n')
+        np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+def export_segment_mesh(mask, name, rgba, mesh_dir, dimensions, max_faces=None):
+    """
+    marching cubes of one segment written to mesh_dir/high_res, and decimated to max_faces in mesh_dir/low_res
+    :return: name, number of high and low resolution faces
+    """
+    name = mesh_name(name)
+    vertices, faces = marching_cubes(mask, dimensions)
+    low_vertices, low_faces = vertices, faces
+    if max_faces is not None:
+        low_vertices, low_faces = decimate(vertices, faces, max_faces)
+
+    for res, (v, fc) in [('high_res', (vertices, faces)), ('low_res', (low_vertices, low_faces))]:
+        res_dir = Path(mesh_dir) / res
+        res_dir.mkdir(parents=True, exist_ok=True)
+        write_obj(res_dir / (name + '.OBJ'), name, v, fc)
+        write_mtl(res_dir / (name + '.mtl'), name, rgba)
+    return name, len(faces), len(low_faces)
@@ -0,0 +1,125 @@
+import os
+import zlib
+
+import nrrd
+import numpy as np
+
+_NRRD_TYPES = {
+    'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+    'int32': 'i4', 'uint32': 'u4', 'int64': 'i8', 'uint64': 'u8',
+    'float': 'f4', 'double': 'f8',
+}
+_NRRD_TYPE_ALIASES = {
+    'signed char': 'int8', 'int8_t': 'int8', 'uchar': 'uint8', 'unsigned char': 'uint8', 'uint8_t': 'uint8',
+    'short': 'int16', 'short int': 'int16', 'signed short': 'int16', 'signed short int': 'int16', 'int16_t': 'int16',
+    'ushort': 'uint16', 'unsigned short': 'uint16', 'unsigned short int': 'uint16', 'uint16_t': 'uint16',
+    'int': 'int32', 'signed int': 'int32', 'int32_t': 'int32',
+    'uint': 'uint32', 'unsigned int': 'uint32', 'uint32_t': 'uint32',
+    'longlong': 'int64', 'long long': 'int64', 'long long int': 'int64', 'signed long long': 'int64',
+    'signed long long int': 'int64', 'int64_t': 'int64',
+    'ulonglong': 'uint64', 'unsigned long long': 'uint64', 'unsigned long long int': 'uint64', 'uint64_t': 'uint64',
+}
+
+
+def nrrd_dtype(header):
+    nrrd_type = _NRRD_TYPE_ALIASES.get(header['type'], header['type'])
+    dtype = np.dtype(_NRRD_TYPES[nrrd_type])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+    return dtype
+
+
+class NrrdStream:
+    """
+    Reads the payload of a NRRD file one z slab at a time. NRRD stores the first axis fastest, so the last axis (z)
+    is contiguous on disk. Raw payloads are memory mapped and gzip payloads are decompressed incrementally, so
+    only one slab is held in memory. Slabs are returned in the same (Fortran) index order as nrrd.read.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self.header = nrrd.read_header(fh)
+            self._data_offset = fh.tell()
+
+        self.sizes = tuple(int(s) for s in self.header['sizes'])
+        self.dtype = nrrd_dtype(self.header)
+        self.encoding = self.header.get('encoding', 'raw')
+        if self.encoding not in ['raw', 'gzip', 'gz']:
+            raise ValueError('Streaming is only supported for raw and gzip encoded NRRDs, got encoding: ' +
+                             self.encoding)
+
+        self._data_file = filename
+        if 'data file' in self.header or 'datafile' in self.header:
+            data_file = self.header.get('data file', self.header.get('datafile'))
+            self._data_file = os.path.join(os.path.dirname(filename), data_file)
+            self._data_offset = 0
+        if self.header.get('line skip', 0) != 0:
+            raise ValueError('Streaming does not support line skip, got line skip: ' + str(self.header['line skip']))
+        self._byte_skip = int(self.header.get('byte skip', 0))
+        self._slice_size = int(np.prod(self.sizes[:-1]))
+
+    @property
+    def num_slices(self):
+        return self.sizes[-1]
+
+    def _memmap(self):
+        nbytes = int(np.prod(self.sizes)) * self.dtype.itemsize
+        if self._byte_skip == -1:
+            offset = os.path.getsize(self._data_file) - nbytes
+        else:
+            offset = self._data_offset + self._byte_skip
+        return np.memmap(self._data_file, dtype=self.dtype, mode='r', offset=offset, shape=self.sizes, order='F')
+
+    def _gzip_slices(self, read_size=1 << 22):
+        """
+        decompress the payload incrementally and yield flat arrays of whole z slices
+        """
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        slice_bytes = self._slice_size * self.dtype.itemsize
+        byte_skip = self._byte_skip
+        buffer = bytearray()
+        with open(self._data_file, 'rb') as fh:
+            fh.seek(self._data_offset)
+            while True:
+                compressed = fh.read(read_size)
+                if not compressed:
+                    buffer += decompressor.flush()
+                else:
+                    buffer += decompressor.decompress(compressed)
+                # byte skip applies to the decompressed payload
+                if byte_skip > 0:
+                    if len(buffer) < byte_skip and compressed:
+                        continue
+                    del buffer[:byte_skip]
+                    byte_skip = 0
+                num_slices = len(buffer) // slice_bytes
+                if num_slices > 0:
+                    yield np.frombuffer(bytes(buffer[:num_slices * slice_bytes]), dtype=self.dtype)
+                    del buffer[:num_slices * slice_bytes]
+                if not compressed:
+                    break
+
+    def iter_slabs(self, slab_size):
+        """
+        :return: generator of (z_start, slab) where slab has shape sizes[:-1] + (n,) with n <= slab_size
+        """
+        if self.encoding == 'raw':
+            data = self._memmap()
+            for z in range(0, self.num_slices, slab_size):
+                yield z, np.asarray(data[..., z:z + slab_size])
+            return
+
+        z = 0
+        pending = []
+        pending_slices = 0
+        for flat in self._gzip_slices():
+            pending.append(flat)
+            pending_slices += flat.size // self._slice_size
+            while pending_slices >= slab_size or (pending_slices > 0 and z + pending_slices == self.num_slices):
+                flat = np.concatenate(pending) if len(pending) > 1 else pending[0]
+                n = min(slab_size, pending_slices)
+                slab = flat[:n * self._slice_size].reshape(self.sizes[:-1] + (n,), order='F')
+                yield z, slab
+                z += n
+                pending = [flat[n * self._slice_size:]]
+                pending_slices -= n
@@ -40,15 +40,19 @@
 #     \version   1.0
 # */
 # //==============================================================================
+import os
+import resource
+import time
 import nrrd
-import PIL.Image
 import numpy as np
 from argparse import ArgumentParser
 
+from nrrd_stream import NrrdStream
+from slice_writer import SliceWriter, save_png
+
 
 def save_image(array, im_name):
-	im = PIL.Image.fromarray(array.astype(np.uint8))
-	im.save(im_name)
+	save_png(array, im_name)
 
 
 def normalize_data(data):
@@ -63,10 +67,99 @@ def scale_data(data, scale):
 	return scaled_data
 
 
-def save_volume_as_images(data, im_prefix):
+def save_volume_as_images(data, im_prefix, writer=None):
+	if writer is None:
+		writer = SliceWriter(workers=1)
 	for i in range(data.shape[2]):
 		im_name = im_prefix + '0' + str(i) + '.png'
-		save_image(data[:, :, i], im_name)
+		writer.save(data[:, :, i], im_name)
+	writer.close()
+
+
+# window level and width in Hounsfield units
+WINDOW_PRESETS = {
+	'bone': (400, 1800),
+	'temporal_bone': (700, 4000),
+	'soft_tissue': (40, 400),
+}
+
+
+def iter_array_slabs(data, slab_size):
+	for z in range(0, data.shape[2], slab_size):
+		yield z, data[:, :, z:z + slab_size]
+
+
+def is_lut_dtype(dtype):
+	return np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2
+
+
+def compute_statistics(slabs, dtype, sample_step=97):
+	"""
+	min, max and a histogram in one pass over the slabs. The histogram is exact for 8 and 16 bit integer volumes,
+	other types keep every sample_step-th voxel for percentiles
+	"""
+	stats = dict(min=None, max=None, hist=None, samples=[])
+	for _, slab in slabs:
+		flat = np.ravel(slab, order='K')
+		stats['min'] = flat.min() if stats['min'] is None else min(stats['min'], flat.min())
+		stats['max'] = flat.max() if stats['max'] is None else max(stats['max'], flat.max())
+		if is_lut_dtype(dtype):
+			offset = np.iinfo(dtype).min
+			hist = np.bincount(flat.astype(np.int32) - offset, minlength=2 ** (8 * dtype.itemsize))
+			stats['hist'] = hist if stats['hist'] is None else stats['hist'] + hist
+		else:
+			stats['samples'].append(flat[::sample_step].astype(np.float32))
+	return stats
+
+
+def intensity_window(stats=None, dtype=None, window=None, level_width=None, percentiles=None):
+	"""
+	:return: intensities (lo, hi) mapped to 0 and 255
+	"""
+	if window is not None:
+		level_width = WINDOW_PRESETS[window]
+	if level_width is not None:
+		level, width = level_width
+		return level - width / 2.0, level + width / 2.0
+	if percentiles is not None:
+		if stats['hist'] is not None:
+			cdf = np.cumsum(stats['hist']) / float(np.sum(stats['hist']))
+			offset = np.iinfo(dtype).min
+			lo = np.searchsorted(cdf, percentiles[0] / 100.0) + offset
+			hi = np.searchsorted(cdf, percentiles[1] / 100.0) + offset
+			return float(lo), float(hi)
+		samples = np.concatenate(stats['samples'])
+		lo, hi = np.percentile(samples, percentiles)
+		return float(lo), float(hi)
+	return float(stats['min']), float(stats['max'])
+
+
+def build_intensity_lut(dtype, lo, hi):
+	info = np.iinfo(dtype)
+	values = np.arange(info.min, info.max + 1, dtype=np.float32)
+	return (np.clip((values - lo) / float(hi - lo), 0.0, 1.0) * 255.9).astype(np.uint8)
+
+
+def map_intensity(slab, lo, hi, lut=None):
+	if lut is not None:
+		offset = np.iinfo(slab.dtype).min
+		if offset == 0:
+			return lut[slab]
+		return lut[slab.astype(np.int32) - offset]
+	normalized_data = np.clip((slab.astype(np.float32) - lo) / float(hi - lo), 0.0, 1.0)
+	return scale_data(normalized_data, 255.9).astype(np.uint8)
+
+
+def save_slabs_as_images(slabs, im_prefix, lo, hi, dtype, writer=None):
+	if writer is None:
+		writer = SliceWriter(workers=1)
+	lut = build_intensity_lut(dtype, lo, hi) if is_lut_dtype(dtype) else None
+	for z, slab in slabs:
+		scaled_data = map_intensity(slab, lo, hi, lut)
+		for i in range(scaled_data.shape[2]):
+			im_name = im_prefix + '0' + str(z + i) + '.png'
+			writer.save(scaled_data[:, :, i], im_name)
+	writer.close()
 
 
 def main():
@@ -76,15 +169,50 @@ def main():
 	parser.add_argument('-p', action='store', dest='image_prefix', help='Specify Image Prefix',
 						default='plane0')
 
+	parser.add_argument('--stream', action='store_true',
+						help='Convert slab by slab in bounded memory (raw or gzip NRRDs)')
+	parser.add_argument('--slab_size', type=int, default=32, help='Number of slices processed at once when streaming')
+	parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes encoding PNG slices')
+	parser.add_argument('--compress_level', type=int, default=6, help='PNG compression level [0-9], lower is faster')
+	parser.add_argument('--optimize', action='store_true', help='Let PNG encoder search for the smallest file')
+	parser.add_argument('--window', choices=list(WINDOW_PRESETS.keys()), default=None,
+						help='Window preset, the default maps the full intensity range')
+	parser.add_argument('--level_width', type=float, nargs=2, default=None, help='Custom window level and width')
+	parser.add_argument('--percentiles', type=float, nargs=2, default=None,
+						help='Map the intensities between two percentiles, e.g. 0.5 99.5 to clip outliers')
+
 	parsed_args = parser.parse_args()
 	print('Specified Arguments')
 	print(parsed_args)
 
-	data, header = nrrd.read(parsed_args.nrrd_file)
-
-	normalized_data = normalize_data(data)
-	scaled_data = scale_data(normalized_data, 255.9)
-	save_volume_as_images(scaled_data, parsed_args.image_prefix)
+	start = time.time()
+	writer = SliceWriter(parsed_args.workers, parsed_args.compress_level, parsed_args.optimize)
+	stream = None
+	if parsed_args.stream:
+		try:
+			stream = NrrdStream(parsed_args.nrrd_file)
+		except ValueError as e:
+			print('Cannot stream ' + parsed_args.nrrd_file + ': ' + str(e) + ', reading the whole volume')
+	if stream is not None:
+		dtype = stream.dtype
+		num_slices = stream.num_slices
+		slabs = lambda: stream.iter_slabs(parsed_args.slab_size)
+	else:
+		data, header = nrrd.read(parsed_args.nrrd_file)
+		dtype = data.dtype
+		num_slices = data.shape[2]
+		slabs = lambda: iter_array_slabs(data, parsed_args.slab_size)
+
+	# statistics are only needed when the window depends on the data, which takes an extra pass when streaming
+	stats = None
+	if parsed_args.window is None and parsed_args.level_width is None:
+		stats = compute_statistics(slabs(), dtype)
+	lo, hi = intensity_window(stats, dtype, parsed_args.window, parsed_args.level_width, parsed_args.percentiles)
+	print('Mapping intensities ', lo, ' to ', hi, ' onto [0, 255]')
+	save_slabs_as_images(slabs(), parsed_args.image_prefix, lo, hi, dtype, writer)
+
+	peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+	print('Converted %d slices in %.2f s, peak memory %.0f MB' % (num_slices, time.time() - start, peak_mb))
 
 if __name__ == '__main__':
     main()
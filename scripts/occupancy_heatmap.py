@@ -0,0 +1,199 @@
+'''
+Accumulates where the drill tip spent time and force inside the anatomy. Drill-tip poses are mapped into the volume
+frame through the recorded volume pose, then into the voxel grid of the volume's PNG stack, and the dwell time and
+force impulse (force x time) of every frame are summed per voxel, chunk by chunk over a session. The heatmap is kept
+sparse and written as <session>_heatmap.npz (voxel indices in plugin order, x = image column, y = row, z = slice). With
+--pngs it is also written as an RGBA PNG stack and volume ADF aligned with the volume, to overlay in the simulator.
+
+The following is an example accumulating a session on a 4x downsampled grid of the 171 volume:
+python3 occupancy_heatmap.py --file ~/recordings/session_1 --volume_adf ../ADF/volume_171.yaml --factor 4 --pngs
+'''
+import os
+import pickle
+from argparse import ArgumentParser
+from pathlib import Path
+
+import cv2
+import h5py
+import numpy as np
+import yaml
+from PIL import Image
+
+from adf_configs import volume_images_config
+from data_validation import iter_chunks
+from frame_index import value_at
+from kinematics import session_groups
+from slice_writer import SliceWriter
+from transform_tree import TransformTree
+from utils import *
+
+
+def conversion_factor(nrrd_header):
+    """
+    meters per AMBF unit, the volume's largest extent is 1 AU (as in data_record.py)
+    """
+    with open(nrrd_header, 'rb') as fp:
+        header = pickle.load(fp)
+    largest_dim = np.argmax(header['sizes'])
+    return np.linalg.norm(header['space directions'][largest_dim]) * header['sizes'][largest_dim] / 1000.0
+
+
+class VolumeGrid:
+    """
+    voxel grid of a volume ADF, shape and voxel size in plugin order
+    """
+    def __init__(self, volume_adf, nrrd_header, shape=None):
+        with open(volume_adf, 'r') as fp:
+            params = yaml.safe_load(fp)
+        self.volume_adf = volume_adf
+        self.volume = params[params['volumes'][0]]
+        images = self.volume['images']
+        self.images_dir = (Path(volume_adf).parent / images['path']).resolve()
+        if shape is None:
+            # the ADF count is only an upper bound, the depth is the number of slices in the stack
+            prefix, suffix = images['prefix'], '.' + images['format']
+            depth = 0
+            while depth < images['count'] and (self.images_dir / (prefix + str(depth) + suffix)).exists():
+                depth += 1
+            if depth == 0:
+                raise FileNotFoundError('No slices %s*%s in %s' % (prefix, suffix, self.images_dir))
+            width, height = Image.open(self.images_dir / (prefix + '0' + suffix)).size
+            shape = (width, height, depth)
+        self.shape = np.array(shape)
+        self.scale = conversion_factor(nrrd_header)
+        dimensions = self.volume['dimensions']
+        self.voxel_size = np.array([dimensions['x'], dimensions['y'], dimensions['z']]) * self.scale / self.shape
+
+    def to_voxels(self, points):
+        """
+        :param points: Nx3 in the volume frame, meters. The volume is centered on its pose
+        :return: Nx3 fractional voxel coordinates
+        """
+        return points / self.voxel_size + self.shape / 2.0 - 0.5
+
+
+class VoxelHeatmap:
+    """
+    Sparse per-voxel sums on a grid downsampled by factor. Every add reduces the samples to their unique voxels, so
+    memory is bounded by the number of voxels the tip visited.
+    """
+    def __init__(self, shape, factor=1):
+        self.factor = factor
+        self.shape = tuple(int(s) for s in np.ceil(np.asarray(shape) / factor))
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.dwell = np.zeros(0)
+        self.impulse = np.zeros(0)
+
+    def add(self, voxels, dt, force):
+        idx = np.floor((voxels + 0.5) / self.factor).astype(np.int64)
+        inside = np.all((idx >= 0) & (idx < self.shape), axis=1)
+        keys = np.ravel_multi_index(tuple(idx[inside].T), self.shape)
+        keys = np.concatenate([self.keys, keys])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.dwell = np.bincount(inverse, np.concatenate([self.dwell, dt[inside]]), len(self.keys))
+        self.impulse = np.bincount(inverse, np.concatenate([self.impulse, (force * dt)[inside]]), len(self.keys))
+
+    @property
+    def indices(self):
+        return np.stack(np.unravel_index(self.keys, self.shape), axis=1)
+
+    def dense(self, values):
+        grid = np.zeros(self.shape, dtype=np.float32)
+        grid.reshape(-1)[self.keys] = values
+        return grid
+
+    def save(self, filename, voxel_size):
+        np.savez_compressed(filename, indices=self.indices.astype(np.int32), dwell=self.dwell, impulse=self.impulse,
+                            shape=self.shape, factor=self.factor, voxel_size=voxel_size * self.factor)
+
+
+def accumulate_file(filename, grid, heatmap, tip_offset, chunk_size):
+    with h5py.File(filename, 'r') as f:
+        frame_times = f['data']['time'][()]
+        if len(frame_times) == 0:
+            return 0
+        if 'wrench' in f.get('drill_force_feedback', {}):
+            force = value_at(f['drill_force_feedback']['time_stamp'][()],
+                             np.linalg.norm(f['drill_force_feedback']['wrench'][:, :3], axis=1), frame_times)
+            force = np.nan_to_num(force)
+        else:
+            force = np.zeros(len(frame_times))
+        # every frame holds the tip until the next one, the last frame of a recording gets no time
+        dt = np.diff(frame_times, append=frame_times[-1])
+
+        for start, end in iter_chunks(len(frame_times), chunk_size):
+            tree = TransformTree.from_recording(f, start, end)
+            tau = tree.lookup('mastoidectomy_volume', 'mastoidectomy_drill')
+            tip = tau[:, :3, -1] + tau[:, :3, :3] @ tip_offset
+            heatmap.add(grid.to_voxels(tip), dt[start:end], force[start:end])
+    return len(frame_times)
+
+
+def heatmap_colors(grid, vmax, colormap=cv2.COLORMAP_INFERNO):
+    """
+    XxYxZ values to RGBA, opacity grows with the value and empty voxels stay transparent
+    """
+    value = np.clip(grid / vmax, 0, 1) if vmax > 0 else np.zeros_like(grid)
+    value8 = (value * 255).astype(np.uint8)
+    rgb = cv2.applyColorMap(value8.reshape(-1, 1), colormap).reshape(grid.shape + (3,))[..., ::-1]
+    alpha = np.where(grid > 0, np.maximum(value8, 32), 0).astype(np.uint8)
+    return np.concatenate([rgb, alpha[..., None]], axis=-1)
+
+
+def save_pngs(heatmap, values, grid, dst_dir, name, prefix):
+    images_dir = Path(dst_dir) / (name + '_heatmap')
+    images_dir.mkdir(parents=True, exist_ok=True)
+    dense = heatmap.dense(values)
+    # robust to a few voxels the tip rested in for a long time
+    vmax = np.percentile(values, 99) if len(values) else 0.0
+    colors = heatmap_colors(dense, vmax)
+    with SliceWriter() as writer:
+        for z in range(dense.shape[2]):
+            # plugin order to image rows (y) and columns (x)
+            writer.save(colors[:, :, z].transpose(1, 0, 2), str(images_dir / (prefix + str(z) + '.png')))
+    adf_file = Path(dst_dir) / (name + '_heatmap.yaml')
+    images_path = os.path.relpath(images_dir, adf_file.parent)
+    volume_images_config(grid.volume_adf, adf_file, images_path, prefix, dense.shape[2])
+    return adf_file
+
+
+def main():
+    resolved_path = str(Path(os.path.dirname(__file__)).resolve())
+
+    parser = ArgumentParser()
+    parser.add_argument('--file', type=str, nargs='+', required=True, help='hdf5 files or session directories')
+    parser.add_argument('--volume_adf', type=str, default=resolved_path + '/../ADF/volume_171.yaml',
+                        help='Volume the session used')
+    parser.add_argument('--nrrd_header', type=str, default=resolved_path + '/../resources/volumes/nrrd_header.pkl',
+                        help='Scale of the volume, same as data_record.py')
+    parser.add_argument('--volume_shape', type=int, nargs=3, default=None,
+                        help='Voxel count (x y z), read from the PNG stack by default')
+    parser.add_argument('--tip_offset', type=float, nargs=3, default=[0.0, 0.0, 0.0],
+                        help='Drill tip in the drill frame, meters')
+    parser.add_argument('--factor', type=int, default=1, help='Downsampling factor of the heatmap grid')
+    parser.add_argument('--output', type=str, default='heatmaps', help='Output directory')
+    parser.add_argument('--pngs', choices=['dwell', 'impulse'], nargs='?', const='dwell', default=None,
+                        help='Also write an RGBA PNG stack and ADF of dwell time or force impulse')
+    parser.add_argument('--image_prefix', type=str, default='plane00')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Frames loaded at once')
+    args = parser.parse_args()
+
+    grid = VolumeGrid(args.volume_adf, args.nrrd_header, args.volume_shape)
+    os.makedirs(args.output, exist_ok=True)
+    tip_offset = np.asarray(args.tip_offset)
+
+    for session, files in session_groups(args.file):
+        heatmap = VoxelHeatmap(grid.shape, args.factor)
+        num_frames = sum(accumulate_file(filename, grid, heatmap, tip_offset, args.chunk_size) for filename in files)
+        name = session.stem
+        heatmap.save(Path(args.output) / (name + '_heatmap.npz'), grid.voxel_size)
+        print(INFO_STR(str(session)), 'frames: %d voxels visited: %d dwell: %.2fs' %
+              (num_frames, len(heatmap.keys), heatmap.dwell.sum()))
+        if args.pngs is not None:
+            values = heatmap.dwell if args.pngs == 'dwell' else heatmap.impulse
+            adf_file = save_pngs(heatmap, values, grid, args.output, name, args.image_prefix)
+            print(OK_STR('Overlay volume written to ' + str(adf_file)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=8)
+def _ray_grid(K, h, w, stride):
+    K = np.array(K).reshape(3, 3)
+    v, u = np.mgrid[0:h:stride, 0:w:stride]
+    uv_one = np.stack([u, v, np.ones_like(u)], axis=-1).astype(np.float64)
+    rays = np.einsum('ab,hwb->hwa', np.linalg.inv(K), uv_one).astype(np.float32)
+    rays.flags.writeable = False
+    return rays
+
+
+def ray_grid(K, h, w, stride=1):
+    """
+    rays K^-1 [u, v, 1] of every stride-th pixel, cached per intrinsic and resolution
+    :return: (H/stride)x(W/stride)x3, read only
+    """
+    return _ray_grid(tuple(np.asarray(K, dtype=np.float64).ravel()), int(h), int(w), int(stride))
+
+
+def backproject(depth, K, stride=1):
+    """
+    :param depth: NxHxW z-values in CV convention
+    :return: Nx(H/stride)x(W/stride)x3 float32 points in the camera frame
+    """
+    h, w = depth.shape[-2:]
+    rays = ray_grid(K, h, w, stride)
+    return rays * depth[..., ::stride, ::stride, None].astype(np.float32)
+
+
+def transform_points(tau, points):
+    """
+    :param tau: Nx4x4 transforms
+    :param points: NxMx3 points
+    """
+    return np.einsum('nab,nmb->nma', tau[:, :3, :3].astype(np.float32), points) + \
+        tau[:, None, :3, -1].astype(np.float32)
+
+
+def voxel_filter(points, voxel_size, colors=None):
+    """
+    one point per occupied voxel, the centroid of the points (and mean color) inside it
+    """
+    keys = np.floor(points / voxel_size).astype(np.int64)
+    keys, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    filtered = np.zeros((len(keys), 3))
+    np.add.at(filtered, inverse, points)
+    filtered = (filtered / counts[:, None]).astype(np.float32)
+    if colors is None:
+        return filtered, None
+    filtered_colors = np.zeros((len(keys), colors.shape[-1]))
+    np.add.at(filtered_colors, inverse, colors)
+    return filtered, (filtered_colors / counts[:, None]).astype(np.uint8)
+
+
+def write_ply(filename, points, colors=None):
+    """
+    binary little endian PLY, colors as Nx3 RGB uint8
+    """
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertices = np.empty(len(points), dtype=fields)
+    vertices['x'], vertices['y'], vertices['z'] = points[:, 0], points[:, 1], points[:, 2]
+    if colors is not None:
+        vertices['red'], vertices['green'], vertices['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % len(points)]
+    header += ['property float ' + n for n in 'xyz']
+    if colors is not None:
+        header += ['property uchar ' + n for n in ['red', 'green', 'blue']]
+    header += ['end_header']
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(vertices.tobytes())
@@ -40,14 +40,21 @@
 #     \version   1.0
 # */
 # //==============================================================================
-from PIL import Image
+import os
 import numpy as np
 import nrrd
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 import re
 from pathlib import Path
 from shutil import rmtree
 
+from build_cache import SliceCache, build_key
+from distance_fields import SIDECAR_NAME, DistanceFields, compute_distance_fields
+from mesh_export import export_segment_mesh
+from nrrd_stream import NrrdStream
+from slice_writer import SliceWriter, save_png
+
 
 class RGBA:
     def __init__(self, rgba):
@@ -133,7 +140,7 @@ class NrrdConverter:
         if self.num_channels == 1:
             self._images_matrix = np.zeros([self.x_dim, self.y_dim,  self.z_dim])
         if self.num_channels == 4:
-            self._images_matrix = np.zeros([self.x_dim, self.y_dim, self.z_dim, self.num_channels])
+            self._images_matrix = np.zeros([self.x_dim, self.y_dim, self.z_dim, self.num_channels], dtype=np.uint8)
         else:
             # Throw some error or warning
             pass
@@ -177,47 +184,156 @@ class NrrdConverter:
             self._segments_infos[i].print_info()
             print('-------------------')
 
-    def copy_volume_to_image_matrix(self):
+    def build_color_luts(self, layer_sizes=None):
+        # One RGBA lookup table per layer, indexed by the voxel value of that layer. For collapsed labelmaps each
+        # label maps to its segment color, otherwise the (binary) voxel value scales the segment color
         are_label_maps_collapsed = self.are_labelmaps_collapsed(self.nrrd_hdr)
+        if layer_sizes is None:
+            layer_sizes = {}
+            for layer in set(seg_info.layer for seg_info in self._segments_infos):
+                layer_sizes[layer] = int(self.nrrd_data[layer].max()) + 1
+
+        luts = {}
+        for layer, size in sorted(layer_sizes.items()):
+            if are_label_maps_collapsed:
+                size = max([size] + [seg_info.label + 1 for seg_info in self._segments_infos
+                                     if seg_info.layer == layer])
+            luts[layer] = np.zeros([size, 4])
+
+        for seg_info in self._segments_infos:
+            lut = luts[seg_info.layer]
+            color = np.array([seg_info.color.R, seg_info.color.G, seg_info.color.B, seg_info.color.A])
+            if are_label_maps_collapsed:
+                lut[seg_info.label] += color
+            else:
+                lut += np.arange(lut.shape[0])[:, None] * color
+        return luts
+
+    def select_segments(self, names):
+        # segments matched by name (case insensitive), all segments if no names are given
+        if len(names) == 0:
+            return list(self._segments_infos)
+        segments = []
+        for name in names:
+            matches = [seg_info for seg_info in self._segments_infos if seg_info.name.lower() == name.lower()]
+            if len(matches) == 0:
+                raise ValueError('No segment named ' + name + ', available: ' +
+                                 ', '.join(seg_info.name for seg_info in self._segments_infos))
+            segments += matches
+        return segments
+
+    def segment_mask(self, seg_info, data):
+        # data holds all label layers (LxXxYxZ), full volume or a slab
+        if self.are_labelmaps_collapsed(self.nrrd_hdr):
+            return data[seg_info.layer] == seg_info.label
+        return data[seg_info.layer] > 0
+
+    def export_spacing(self):
+        # voxel size in mm of the three spatial axes after downsampling
+        ratios = np.array([self.x_dim_ratio, self.y_dim_ratio, self.z_dim_ratio], dtype=float)
+        if 'space directions' not in self.nrrd_hdr:
+            print('WARN! No space directions in NRRD header, assuming 1 mm voxels')
+            return ratios
+        directions = np.array(self.nrrd_hdr['space directions'], dtype=float)[-3:]
+        return np.linalg.norm(directions, axis=1) * ratios
+
+    def compute_distance_fields(self, segments, masks, step_mm=0.1):
+        spacing = self.export_spacing()
+        fields = compute_distance_fields(masks, spacing, step_mm)
+        # fields are in plugin voxel order, the first two axes are swapped with respect to the NRRD
+        return DistanceFields(fields, [seg_info.name for seg_info in segments], step_mm, spacing[[1, 0, 2]])
+
+    def export_meshes(self, segments, masks, mesh_dir, dimensions, max_faces=None, workers=None):
+        """
+        Marching cubes of every segment in a process pool, written as OBJ/MTL to mesh_dir/high_res and, decimated to
+        max_faces triangles, to mesh_dir/low_res. Masks are in NRRD order at export resolution
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for seg_info, mask in zip(segments, masks):
+                if not mask.any():
+                    print('WARN! Segment ', seg_info.name, ' is empty at export resolution, no mesh written')
+                    continue
+                rgba = [seg_info.color.R, seg_info.color.G, seg_info.color.B, seg_info.color.A]
+                # plugin voxel order, the first two axes are swapped with respect to the NRRD
+                futures.append(executor.submit(export_segment_mesh, mask.transpose(1, 0, 2), seg_info.name, rgba,
+                                               mesh_dir, dimensions, max_faces))
+            for future in futures:
+                name, num_faces, num_low_faces = future.result()
+                print('Mesh ', name, ' faces high_res: ', num_faces, ' low_res: ', num_low_faces)
+
+    def colorize_slab(self, luts, slab):
+        """
+        map a slab of label layers (LxXxYxZs) to RGBA uint8 (XxYxZsx4), luts are grown when larger labels show up
+        """
+        for layer, lut in list(luts.items()):
+            max_value = int(slab[layer].max())
+            if max_value >= lut.shape[0]:
+                sizes = {l: t.shape[0] for l, t in luts.items()}
+                sizes[layer] = max_value + 1
+                luts.update(self.build_color_luts(sizes))
+
+        if len(luts) == 1:
+            # single layer, map labels straight to uint8
+            layer, lut = list(luts.items())[0]
+            lut = np.clip(lut * 255, 0, 255).astype(np.uint8)
+            return lut[slab[layer].astype(np.intp)]
+
+        # overlapping layers add up and saturate at 255. The per-segment conversion this replaced cast the float sum
+        # to uint8 when saving, which wrapped around (e.g. 300 -> 44) where segments of different layers overlap
+        acc = None
+        for layer, lut in luts.items():
+            rgba = lut.astype(np.float32)[slab[layer].astype(np.intp)]
+            acc = rgba if acc is None else acc + rgba
+        return np.clip(acc * 255, 0, 255).astype(np.uint8)
+
+    def copy_volume_to_image_matrix(self, slab_size=16):
         if self.num_channels == 4:
-            # for nl in range(self.num_layers):
-            #     seg_data = self.nrrd_data[nl, :, :, :]
-            #     print('Layer Number: ', nl)
-            #     R = seg_data * self._segments_colors[nl, 0]
-            #     print('\tStep: ', 1)
-            #     G = seg_data * self._segments_colors[nl, 1]
-            #     print ('\tStep: ', 2)
-            #     B = seg_data * self._segments_colors[nl, 2]
-            #     print('\tStep: ', 3)
-            #     A = seg_data * self._segments_colors[nl, 3]
-            #     print('\tStep: ', 4)
-            #     RGBA = np.stack((R, G, B, A), axis=-1)
-            #     print('\tStep: ', 5)
-            #     self._images_matrix += RGBA
-            #     print('\tStep: ', 6)
-
-            for seg_info in self._segments_infos:
-                seg_data = self.nrrd_data[seg_info.layer, :, :, :]
-                if are_label_maps_collapsed:
-                    label = seg_info.label
-                    print('Processing Segmentation')
-                    seg_info.print_info()
-                    data = (seg_data == label).astype(int)
-                else:
-                    data = seg_data
-                print('Layer Number: ', seg_info.layer)
-                R = data * seg_info.color.R
-                print('\tStep: ', 1)
-                G = data * seg_info.color.G
-                print('\tStep: ', 2)
-                B = data * seg_info.color.B
-                print('\tStep: ', 3)
-                A = data * seg_info.color.A
-                print('\tStep: ', 4)
-                RGBA = np.stack((R, G, B, A), axis=-1)
-                print('\tStep: ', 5)
-                self._images_matrix += RGBA
-                print('\tStep: ', 6)
+            luts = self.build_color_luts()
+            for z in range(0, self.z_dim, slab_size):
+                slab = self.nrrd_data[:, :, :, z:z + slab_size]
+                self._images_matrix[:, :, z:z + slab_size] = self.colorize_slab(luts, slab)
+
+    def convert_stream(self, filename, dst_path: Path, im_prefix, slab_size=16, writer=None, mask_names=None):
+        """
+        Read, downsample, colorize and save the volume one z slab at a time without holding the whole volume
+        :return: segments selected by mask_names and their export resolution masks, if mask_names is given
+        """
+        stream = NrrdStream(filename)
+        self.nrrd_hdr = stream.header
+        self.initialize_segments_infos()
+        self.print_segments_infos()
+
+        x_step = self.x_dim_ratio
+        y_step = self.y_dim_ratio
+        z_step = self.z_dim_ratio
+        self.num_layers = stream.sizes[0]
+        self.x_dim = len(range(0, stream.sizes[1], x_step))
+        self.y_dim = len(range(0, stream.sizes[2], y_step))
+        self.z_dim = len(range(0, stream.sizes[3], z_step))
+        self.num_channels = 4
+
+        if writer is None:
+            writer = SliceWriter(workers=1)
+        # labels seen so far, the luts grow as needed
+        luts = self.build_color_luts({seg_info.layer: 2 for seg_info in self._segments_infos})
+        mask_segments, masks = None, None
+        if mask_names is not None:
+            mask_segments = self.select_segments(mask_names)
+            masks = [np.zeros([self.x_dim, self.y_dim, self.z_dim], dtype=bool) for _ in mask_segments]
+        print("Saving volume to png images at " + str(dst_path) + "...")
+        # slabs start at multiples of z_step so that the downsampling matches read_nrrd
+        for z, slab in stream.iter_slabs(slab_size * z_step):
+            slab = slab[:, ::x_step, ::y_step, ::z_step]
+            images = self.colorize_slab(luts, slab)
+            for i in range(images.shape[2]):
+                im_name = im_prefix + f"{z // z_step + i}" + ".png"
+                writer.save(images[:, :, i, :], str(dst_path / im_name))
+            if masks is not None:
+                for mask, seg_info in zip(masks, mask_segments):
+                    mask[:, :, z // z_step:z // z_step + slab.shape[-1]] = self.segment_mask(seg_info, slab)
+        writer.close()
+        return mask_segments, masks
 
     def normalize_image_matrix_data(self):
         max = self._images_matrix.max()
@@ -238,15 +354,17 @@ class NrrdConverter:
         return scaled_data
 
     def save_image(self, array, im_name):
-        im = Image.fromarray(array.astype(np.uint8))
-        im.save(im_name)
+        save_png(array, im_name)
 
-    def save_image_matrix_as_images(self, dst_path: Path, im_prefix):
+    def save_image_matrix_as_images(self, dst_path: Path, im_prefix, writer=None):
+        if writer is None:
+            writer = SliceWriter(workers=1)
         print("Saving volume to png images at " + str(dst_path) + "...")
         for nz in range(self.z_dim):
             im_name = im_prefix + f"{nz}" + ".png"
             im_name = str(dst_path / im_name)
-            self.save_image(self._images_matrix[:, :, nz, :], im_name)
+            writer.save(self._images_matrix[:, :, nz, :], im_name)
+        writer.close()
 
     @staticmethod
     def are_labelmaps_collapsed(h):
@@ -275,26 +393,93 @@ def main():
     parser.add_argument('--rx', action='store', dest='x_skip', help='X axis order [1-100]. Higher value indicates greater reduction', default=2)
     parser.add_argument('--ry', action='store', dest='y_skip', help='Y axis order [1-100]. Higher value indicates greater reduction', default=2)
     parser.add_argument('--rz', action='store', dest='z_skip', help='Z axis order [1-100]. Higher value indicates greater reduction', default=2)
+    parser.add_argument('--stream', action='store_true', help='Convert slab by slab in bounded memory (raw or gzip NRRDs)')
+    parser.add_argument('--slab_size', type=int, default=16, help='Number of output slices processed at once when streaming')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes encoding PNG slices')
+    parser.add_argument('--compress_level', type=int, default=6, help='PNG compression level [0-9], lower is faster')
+    parser.add_argument('--optimize', action='store_true', help='Let PNG encoder search for the smallest file')
+    parser.add_argument('--clean', action='store_true', help='Remove the destination and rebuild every slice')
+    parser.add_argument('--distance_fields', type=str, nargs='*', default=None,
+                        help='Also save distance fields to these segments (all if no names given) next to the images')
+    parser.add_argument('--distance_step', type=float, default=0.1,
+                        help='Distance field quantization in mm, fields saturate at 255 steps')
+    parser.add_argument('--meshes', type=str, default=None,
+                        help='Also export segment surfaces to high_res and low_res folders of this directory')
+    parser.add_argument('--mesh_segments', type=str, nargs='*', default=[], help='Segments to mesh, all by default')
+    parser.add_argument('--triangle_budget', type=int, default=20000, help='Max triangles of each low_res mesh')
+    parser.add_argument('--mesh_dimensions', type=float, nargs=3, default=[1.0, 1.0, 1.0],
+                        help='Volume dimensions in the volume ADF, meshes are placed to overlay the volume')
     parsed_args = parser.parse_args()
     print('Specified Arguments')
     print(parsed_args)
 
     nrrd_converter = NrrdConverter(int(parsed_args.x_skip), int(parsed_args.y_skip), int(parsed_args.z_skip))
-    nrrd_converter.read_nrrd(parsed_args.nrrd_file)
-    nrrd_converter.initialize_image_matrix()
-    nrrd_converter.initialize_segments_infos()
-    nrrd_converter.print_segments_infos()
-
-    nrrd_converter.copy_volume_to_image_matrix()
-    # nrrd_converter.normalize_image_matrix_data()
-    nrrd_converter.scale_image_matrix_data(255)
-    
+    writer = SliceWriter(parsed_args.workers, parsed_args.compress_level, parsed_args.optimize)
+
     dst_path = Path(parsed_args.dst_p)
-    if dst_path.exists():
+    if parsed_args.clean and dst_path.exists():
         rmtree(dst_path)
-    dst_path.mkdir()
-    nrrd_converter.save_image_matrix_as_images(dst_path, parsed_args.image_prefix)
-
+    dst_path.mkdir(parents=True, exist_ok=True)
+    # slices are rewritten only when their content changed since the last build into dst_path
+    params = dict(rx=parsed_args.x_skip, ry=parsed_args.y_skip, rz=parsed_args.z_skip, prefix=parsed_args.image_prefix,
+                  compress_level=parsed_args.compress_level, optimize=parsed_args.optimize)
+    cache = SliceCache(dst_path, build_key(parsed_args.nrrd_file, params), writer)
+    sidecar_file = dst_path / SIDECAR_NAME
+    # the sidecar records the image build it was computed with
+    distance_key = cache.key + str(parsed_args.distance_fields) + str(parsed_args.distance_step)
+    sidecar_up_to_date = parsed_args.distance_fields is None or \
+        (sidecar_file.exists() and DistanceFields.load(sidecar_file).build_key == distance_key)
+    if cache.is_up_to_date() and sidecar_up_to_date and parsed_args.meshes is None:
+        print('Images at ' + str(dst_path) + ' are up to date')
+        writer.close()
+        return
+
+    # segments whose masks are needed, an empty list selects all
+    selections = [names for names in [parsed_args.distance_fields,
+                                      parsed_args.mesh_segments if parsed_args.meshes is not None else None]
+                  if names is not None]
+    mask_names = None
+    if len(selections) > 0:
+        mask_names = [] if any(len(names) == 0 for names in selections) else sum(selections, [])
+
+    if parsed_args.stream:
+        try:
+            NrrdStream(parsed_args.nrrd_file)
+        except ValueError as e:
+            print('Cannot stream ' + parsed_args.nrrd_file + ': ' + str(e) + ', reading the whole volume')
+            parsed_args.stream = False
+    if parsed_args.stream:
+        mask_segments, masks = nrrd_converter.convert_stream(parsed_args.nrrd_file, dst_path, parsed_args.image_prefix,
+                                                             parsed_args.slab_size, cache, mask_names)
+    else:
+        nrrd_converter.read_nrrd(parsed_args.nrrd_file)
+        nrrd_converter.initialize_image_matrix()
+        nrrd_converter.initialize_segments_infos()
+        nrrd_converter.print_segments_infos()
+
+        # colors are scaled to [0, 255] while copying
+        nrrd_converter.copy_volume_to_image_matrix()
+        nrrd_converter.save_image_matrix_as_images(dst_path, parsed_args.image_prefix, cache)
+        if mask_names is not None:
+            mask_segments = nrrd_converter.select_segments(mask_names)
+            masks = [nrrd_converter.segment_mask(seg_info, nrrd_converter.nrrd_data) for seg_info in mask_segments]
+    if mask_names is not None:
+        masks_by_index = {seg_info.index: mask for seg_info, mask in zip(mask_segments, masks)}
+
+    if parsed_args.distance_fields is not None:
+        distance_segments = nrrd_converter.select_segments(parsed_args.distance_fields)
+        distance_fields = nrrd_converter.compute_distance_fields(
+            distance_segments, [masks_by_index[seg_info.index] for seg_info in distance_segments],
+            parsed_args.distance_step)
+        distance_fields.build_key = distance_key
+        distance_fields.save(sidecar_file)
+        print('Saved distance fields to ', ', '.join(distance_fields.names), ' at ', sidecar_file)
+
+    if parsed_args.meshes is not None:
+        mesh_segments = nrrd_converter.select_segments(parsed_args.mesh_segments)
+        nrrd_converter.export_meshes(mesh_segments, [masks_by_index[seg_info.index] for seg_info in mesh_segments],
+                                     parsed_args.meshes, parsed_args.mesh_dimensions, parsed_args.triangle_budget,
+                                     parsed_args.workers)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,79 @@
+from functools import lru_cache
+
+import numpy as np
+
+# colors in the channel order recordings store segm in (BGR)
+DRILL_COLOR = np.array([33, 32, 34])
+MASTOID_COLOR = np.array([219, 249, 255])
+DEFAULT_PALETTE = {'drill': DRILL_COLOR, 'mastoid': MASTOID_COLOR}
+
+
+def pack_colors(segm):
+    """
+    24 bit key of every pixel, NxHxWx3 uint8 to NxHxW uint32
+    """
+    segm = np.asarray(segm)
+    return (segm[..., 0].astype(np.uint32) << 16) | (segm[..., 1].astype(np.uint32) << 8) | segm[..., 2]
+
+
+def pack_color(color):
+    return (int(color[0]) << 16) | (int(color[1]) << 8) | int(color[2])
+
+
+@lru_cache(maxsize=4)
+def _class_lut(keys):
+    lut = np.zeros(1 << 24, dtype=np.uint8)
+    for class_id, key in enumerate(keys):
+        lut[key] = class_id + 1
+    lut.flags.writeable = False
+    return lut
+
+
+def palette_from_segments(segments_infos):
+    """
+    palette of the colors the volume is rendered with, from seg_nrrd_to_pngs SegmentInfo (RGB in [0, 1]). Colors are
+    truncated to uint8 as in NrrdConverter.colorize_slab
+    """
+    palette = {}
+    for seg_info in segments_infos:
+        rgb = np.clip(np.array([seg_info.color.R, seg_info.color.G, seg_info.color.B]) * 255, 0, 255)
+        palette[seg_info.name] = rgb.astype(np.uint8)[::-1]
+    return palette
+
+
+class SegmClassifier:
+    """
+    Maps segmentation images to class ids through a 2^24 entry lookup table of packed colors. Class 0 is every
+    color not in the palette, class i + 1 is names[i].
+    """
+    def __init__(self, palette):
+        self.names = list(palette.keys())
+        self.keys = tuple(pack_color(c) for c in palette.values())
+        if len(self.keys) > 255:
+            raise ValueError('At most 255 classes are supported, got %d' % len(self.keys))
+        self._lut = _class_lut(self.keys)
+
+    @property
+    def num_classes(self):
+        return len(self.names) + 1
+
+    def class_id(self, name):
+        return self.names.index(name) + 1
+
+    def labels(self, segm):
+        """
+        :return: NxHxW uint8 class ids
+        """
+        return self._lut[pack_colors(segm)]
+
+    def counts(self, labels):
+        """
+        :return: NxC pixel count of every class in each frame
+        """
+        n = labels.shape[0]
+        offsets = (np.arange(n, dtype=np.int64) * self.num_classes).reshape((n,) + (1,) * (labels.ndim - 1))
+        return np.bincount((labels + offsets).ravel(), minlength=n * self.num_classes).reshape(n, self.num_classes)
+
+    def classify(self, segm):
+        labels = self.labels(segm)
+        return labels, self.counts(labels)
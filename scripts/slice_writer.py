@@ -0,0 +1,51 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def save_png(array, im_name, compress_level=6, optimize=False):
+    if array.dtype != np.uint8:
+        array = array.astype(np.uint8)
+    # encode next to the target and rename, readers never see a partially written slice
+    tmp_name = str(im_name) + '.tmp'
+    Image.fromarray(array).save(tmp_name, format='PNG', compress_level=compress_level, optimize=optimize)
+    os.replace(tmp_name, im_name)
+
+
+class SliceWriter:
+    """
+    Encodes PNG slices in a process pool. Slices are expected as uint8 and passed through as is, the number of
+    slices waiting to be encoded is bounded so memory stays flat. With workers <= 1 slices are written inline.
+    """
+    def __init__(self, workers=None, compress_level=6, optimize=False):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.compress_level = compress_level
+        self.optimize = optimize
+        self._pending = deque()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+    def save(self, array, im_name):
+        if self._executor is None:
+            save_png(array, im_name, self.compress_level, self.optimize)
+            return
+        self._pending.append(self._executor.submit(save_png, np.ascontiguousarray(array), str(im_name),
+                                                   self.compress_level, self.optimize))
+        while len(self._pending) > 2 * self.workers:
+            # raises if encoding failed
+            self._pending.popleft().result()
+
+    def close(self):
+        while self._pending:
+            self._pending.popleft().result()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
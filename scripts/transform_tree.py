@@ -0,0 +1,106 @@
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+WORLD = 'world'
+# the main camera in OpenCV convention, T_main_camera_cv = extrinsic^-1
+CV = 'cv'
+
+
+def pose_to_matrix(pose):
+    """
+    :param pose: ...x7 [x, y, z, qx, qy, qz, qw]
+    :return: ...x4x4
+    """
+    pose = np.asarray(pose)
+    quat_norm = np.linalg.norm(pose[..., 3:], axis=-1)
+    assert np.all(np.isclose(quat_norm, 1.0))
+    tau = np.zeros(pose.shape[:-1] + (4, 4))
+    tau[..., :3, :3] = R.from_quat(pose[..., 3:].reshape(-1, 4)).as_matrix().reshape(pose.shape[:-1] + (3, 3))
+    tau[..., :3, -1] = pose[..., :3]
+    tau[..., 3, 3] = 1.0
+    return tau
+
+
+def invert_transform(tau):
+    """
+    closed form inverse of a batch of rigid transforms
+    :param tau: Nx4x4
+    :return: Nx4x4
+    """
+    r_t = np.swapaxes(tau[..., :3, :3], -1, -2)
+    tau_inv = np.zeros_like(tau)
+    tau_inv[..., :3, :3] = r_t
+    tau_inv[..., :3, -1] = -np.einsum('...ab,...b->...a', r_t, tau[..., :3, -1])
+    tau_inv[..., 3, 3] = 1.0
+    return tau_inv
+
+
+class TransformTree:
+    """
+    Frames of a recording and the transforms between them for all time stamps at once. Every pose_<name> stream is a
+    frame <name> under world (T_world_<name>), static transforms such as the camera extrinsic are 4x4 edges that
+    broadcast over time. lookup(target, source) returns T_target_source for every frame and caches it.
+    """
+    def __init__(self):
+        self._parents = {}
+        self._cache = {}
+
+    def add(self, parent, child, tau):
+        """
+        :param tau: Nx4x4 or 4x4, T_parent_child
+        """
+        self._parents[child] = (parent, np.asarray(tau, dtype=np.float64))
+        self._cache = {}
+
+    @property
+    def frames(self):
+        return [WORLD] + list(self._parents.keys())
+
+    @staticmethod
+    def from_recording(files, start=0, end=None):
+        """
+        :param files: open h5py file or list of them (chunks of one session, concatenated in order)
+        :param start, end: frame range of a single file
+        """
+        if not isinstance(files, (list, tuple)):
+            files = [files]
+        tree = TransformTree()
+        keys = [key for key in files[0]['data'].keys() if key.startswith('pose_')]
+        for key in keys:
+            poses = np.concatenate([f['data'][key][start:end] for f in files], axis=0)
+            tree.add(WORLD, key[len('pose_'):], pose_to_matrix(poses))
+        if 'main_camera' in tree._parents:
+            extrinsic = files[0]['metadata']['camera_extrinsic'][()]
+            tree.add('main_camera', CV, invert_transform(extrinsic.astype(np.float64)))
+        return tree
+
+    def to_world(self, frame):
+        """
+        T_world_frame, composed along the parents
+        """
+        if frame == WORLD:
+            return np.identity(4)
+        key = (WORLD, frame)
+        if key not in self._cache:
+            parent, tau = self._parents[frame]
+            self._cache[key] = tau if parent == WORLD else self.to_world(parent) @ tau
+        return self._cache[key]
+
+    def lookup(self, target, source):
+        """
+        :return: T_target_source, Nx4x4 (4x4 if no pose stream is involved)
+        """
+        if target == WORLD:
+            return self.to_world(source)
+        key = (target, source)
+        if key not in self._cache:
+            self._cache[key] = invert_transform(self.to_world(target)) @ self.to_world(source)
+        return self._cache[key]
+
+    def relative(self, target, source, step=1):
+        """
+        maps points given in target at frame i that move rigidly with source to target at frame i + step,
+        T_target(i+step)_source(i+step) @ T_source(i)_target(i), (N-step)x4x4
+        """
+        tau = self.lookup(target, source)
+        return tau[step:] @ invert_transform(tau[:-step])
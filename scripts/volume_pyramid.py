@@ -0,0 +1,156 @@
+'''
+Builds several resolutions of a volume from a single streamed read of a NRRD file. Each level is pooled over
+factor^3 blocks (mean for intensity volumes, majority or max for label volumes) instead of strided slicing, written
+to its own PNG stack and given a matching volume ADF.
+
+The following is an example producing the 512, 256 and 171 levels of a segmented volume:
+python3 volume_pyramid.py -n ear3.seg.nrrd --name ear3 --factors 1 2 3
+'''
+import math
+import os
+from argparse import ArgumentParser
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+
+from adf_configs import volume_images_config
+from nrrd_stream import NrrdStream
+from seg_nrrd_to_pngs import NrrdConverter
+from slice_writer import SliceWriter
+
+
+def pool_blocks(data, factor):
+    '''
+    view a XxYxZ array as (X/f)x(Y/f)x(Z/f)xf^3 blocks, borders are padded with edge values
+    '''
+    pad = [(0, -s % factor) for s in data.shape]
+    if any(p[1] for p in pad):
+        data = np.pad(data, pad, mode='edge')
+    x, y, z = [s // factor for s in data.shape]
+    blocks = data.reshape(x, factor, y, factor, z, factor).transpose(0, 2, 4, 1, 3, 5)
+    return blocks.reshape(x, y, z, factor ** 3)
+
+
+def pool_mean(data, factor):
+    if factor == 1:
+        return data.astype(np.float32)
+    return pool_blocks(data, factor).mean(axis=-1, dtype=np.float32)
+
+
+def pool_max(data, factor):
+    if factor == 1:
+        return data
+    return pool_blocks(data, factor).max(axis=-1)
+
+
+def pool_majority(data, factor):
+    '''
+    most frequent label of each block, ties go to the lower label
+    '''
+    if factor == 1:
+        return data
+    blocks = pool_blocks(data, factor)
+    best = np.zeros(blocks.shape[:3], dtype=data.dtype)
+    best_count = np.full(blocks.shape[:3], -1, dtype=np.int32)
+    for label in np.unique(blocks):
+        count = np.count_nonzero(blocks == label, axis=-1)
+        better = count > best_count
+        best[better] = label
+        best_count[better] = count[better]
+    return best
+
+
+class PyramidLevel:
+    def __init__(self, factor, sizes, name, dst_dir, adf_dir, prefix):
+        self.factor = factor
+        self.dims = [int(math.ceil(s / factor)) for s in sizes]
+        self.images_dir = Path(dst_dir) / (name + '_' + str(self.dims[0]))
+        self.adf_file = Path(adf_dir) / ('volume_' + str(self.dims[0]) + '_' + name + '.yaml')
+        self.prefix = prefix
+        # optional writer of this level only, e.g. a SliceCache of images_dir
+        self.writer = None
+
+    def print_info(self):
+        print('Factor: ', self.factor, ' Dims: ', self.dims, ' Images: ', self.images_dir, ' ADF: ', self.adf_file)
+
+
+def build_pyramid(nrrd_file, levels, mode, label_pooling, slab_size, writer, value_range=None):
+    stream = NrrdStream(nrrd_file)
+    # slabs start at a common multiple of all factors so that every level's blocks line up
+    z_block = reduce(lambda a, b: a * b // math.gcd(a, b), [level.factor for level in levels])
+
+    if mode == 'seg':
+        converter = NrrdConverter(1, 1, 1)
+        converter.nrrd_hdr = stream.header
+        converter.initialize_segments_infos()
+        converter.print_segments_infos()
+        luts = converter.build_color_luts({seg_info.layer: 2 for seg_info in converter._segments_infos})
+        pool = pool_majority if label_pooling == 'majority' else pool_max
+    elif value_range is None:
+        value_range = [None, None]
+        for _, slab in stream.iter_slabs(z_block * slab_size):
+            value_range[0] = slab.min() if value_range[0] is None else min(value_range[0], slab.min())
+            value_range[1] = slab.max() if value_range[1] is None else max(value_range[1], slab.max())
+
+    for z, slab in stream.iter_slabs(z_block * slab_size):
+        for level in levels:
+            if mode == 'seg':
+                pooled = np.stack([pool(slab[layer], level.factor) for layer in range(slab.shape[0])], axis=0)
+                images = converter.colorize_slab(luts, pooled)
+            else:
+                normalized = (pool_mean(slab, level.factor) - value_range[0]) / float(value_range[1] - value_range[0])
+                images = (np.clip(normalized, 0.0, 1.0) * 255.9).astype(np.uint8)
+            z_level = z // level.factor
+            level_writer = writer if level.writer is None else level.writer
+            for i in range(images.shape[2]):
+                level_writer.save(images[:, :, i], str(level.images_dir / (level.prefix + str(z_level + i) + '.png')))
+        print('Processed slices ', z, ' to ', z + slab.shape[-1])
+    for level in levels:
+        if level.writer is not None:
+            level.writer.close()
+    writer.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', action='store', dest='nrrd_file', help='Specify Nrrd File', required=True)
+    parser.add_argument('--name', type=str, required=True, help='Volume name, e.g. LT138')
+    parser.add_argument('-p', action='store', dest='image_prefix', help='Specify Image Prefix', default='plane00')
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 2, 3], help='Reduction factor of each level')
+    parser.add_argument('--mode', choices=['seg', 'intensity'], default='seg',
+                        help='seg: labeled NRRD colorized from its segments, intensity: grayscale CT')
+    parser.add_argument('--label_pooling', choices=['majority', 'max'], default='majority',
+                        help='max keeps thin structures that majority pooling can drop')
+    parser.add_argument('--range', type=float, nargs=2, default=None,
+                        help='Intensity mapped to [0, 255], computed from the volume if not given')
+    parser.add_argument('--dst_dir', type=str, default='../resources/volumes', help='Parent directory of PNG stacks')
+    parser.add_argument('--adf_dir', type=str, default='../ADF', help='Directory of generated volume ADFs')
+    parser.add_argument('--template_adf', type=str, default='../ADF/volume_256.yaml', help='Volume ADF to start from')
+    parser.add_argument('--slab_size', type=int, default=4, help='Number of z blocks processed at once')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes encoding PNG slices')
+    parser.add_argument('--compress_level', type=int, default=6, help='PNG compression level [0-9], lower is faster')
+    parsed_args = parser.parse_args()
+    print('Specified Arguments')
+    print(parsed_args)
+
+    sizes = NrrdStream(parsed_args.nrrd_file).sizes
+    if parsed_args.mode == 'seg':
+        sizes = sizes[1:]
+    levels = [PyramidLevel(f, sizes, parsed_args.name, parsed_args.dst_dir, parsed_args.adf_dir,
+                           parsed_args.image_prefix) for f in sorted(set(parsed_args.factors))]
+    for level in levels:
+        level.print_info()
+        level.images_dir.mkdir(parents=True, exist_ok=True)
+
+    writer = SliceWriter(parsed_args.workers, parsed_args.compress_level)
+    build_pyramid(parsed_args.nrrd_file, levels, parsed_args.mode, parsed_args.label_pooling, parsed_args.slab_size,
+                  writer, parsed_args.range)
+
+    for level in levels:
+        images_path = os.path.relpath(level.images_dir, level.adf_file.parent)
+        volume_images_config(parsed_args.template_adf, level.adf_file, images_path, level.prefix, level.dims[2])
+
+
+if __name__ == '__main__':
+    main()